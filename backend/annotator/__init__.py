@@ -20,4 +20,35 @@ def create_app():
 
     app.register_blueprint(routes.bp)
 
+    from annotator import inference
+
+    inference.configure(
+        dtype=app.config['INFERENCE_DTYPE'],
+        channels_last=app.config['INFERENCE_CHANNELS_LAST'],
+        inference_mode=app.config['INFERENCE_MODE'],
+    )
+
+    from annotator.recognition.model_cache import model_cache
+
+    model_cache.configure(
+        max_models=app.config['RECOGNITION_CACHE_SIZE'],
+        max_bytes=app.config['RECOGNITION_CACHE_BYTES'],
+    )
+
+    from annotator.page_cache import page_memory_cache
+
+    page_memory_cache.configure(max_bytes=app.config['PAGE_CACHE_BYTES'])
+
+    from annotator.jobs import job_manager, training_manager
+
+    job_manager.configure(max_workers=app.config['JOB_WORKERS'])
+    training_manager.configure(max_queued=app.config['FINETUNE_QUEUE_SIZE'])
+
+    from annotator.segmentation import configure_detector, get_detector
+
+    configure_detector(idle_seconds=app.config['DETECTOR_IDLE_SECONDS'])
+
+    if app.config['WARM_DETECTOR']:
+        get_detector(app.config['CRAFT_MODEL_PATH'])
+
     return app
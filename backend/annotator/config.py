@@ -6,4 +6,50 @@ load_dotenv('.env')
 class Config(object):
     SQLALCHEMY_DATABASE_URI = "sqlite:///project.db"
     DATA_PATH = os.environ.get('DATA_PATH', default='instance')
+    CRAFT_MODEL_PATH = os.environ.get(
+        'CRAFT_MODEL_PATH',
+        default='/mnt/cai-data/manuscript-annotation-tool/models/segmentation/craft_mlt_25k.pth',
+    )
+    # load the CRAFT detector in create_app() instead of on the first upload
+    WARM_DETECTOR = os.environ.get('WARM_DETECTOR', default='false').lower() == 'true'
+    # unload the CRAFT detector after this many seconds without use (0 = keep it loaded)
+    DETECTOR_IDLE_SECONDS = float(os.environ.get('DETECTOR_IDLE_SECONDS', default=0))
+    # leaves of similar size run through CRAFT together; full-resolution leaves are large, so size this to the device
+    DETECTION_BATCH_SIZE = int(os.environ.get('DETECTION_BATCH_SIZE', default=1))
+    # detect large leaves in overlapping tiles (multiples of 32 px; 0 = whole leaf), or pick
+    # the tile size from a memory ceiling for one forward pass (0 = no ceiling)
+    DETECTION_TILE_SIZE = int(os.environ.get('DETECTION_TILE_SIZE', default=0))
+    DETECTION_TILE_OVERLAP = int(os.environ.get('DETECTION_TILE_OVERLAP', default=256))
+    DETECTION_MAX_MEMORY_MB = int(os.environ.get('DETECTION_MAX_MEMORY_MB', default=0))
+    # run CRAFT on leaves downscaled by this factor, or 'auto' to pick it per leaf from its line pitch
+    DETECTION_SCALE = os.environ.get('DETECTION_SCALE', default='1.0')
+    DETECTION_SCALE = DETECTION_SCALE if DETECTION_SCALE == 'auto' else float(DETECTION_SCALE)
+    # inference precision of the detector and the recognisers: float32 or bfloat16 (autocast),
+    # NHWC memory format, and torch.inference_mode() instead of torch.no_grad()
+    INFERENCE_DTYPE = os.environ.get('INFERENCE_DTYPE', default='float32')
+    INFERENCE_CHANNELS_LAST = os.environ.get('INFERENCE_CHANNELS_LAST', default='false').lower() == 'true'
+    INFERENCE_MODE = os.environ.get('INFERENCE_MODE', default='true').lower() == 'true'
+    # number of loaded recognition models kept in memory, and their total size budget
+    RECOGNITION_CACHE_SIZE = int(os.environ.get('RECOGNITION_CACHE_SIZE', default=2))
+    RECOGNITION_CACHE_BYTES = int(os.environ.get('RECOGNITION_CACHE_BYTES', default=2 * 1024 ** 3))
+    # reuse the recognised text of line images that did not change since they were last recognised with a model
+    RECOGNITION_RESULT_CACHE = os.environ.get('RECOGNITION_RESULT_CACHE', default='true').lower() == 'true'
+    # CTC decoding of the recognisers: greedy, or beamsearch with a character n-gram model of the
+    # corrected lines (BEAM_LM_ORDER = 0 or BEAM_LM_WEIGHT = 0 disables the language model)
+    RECOGNITION_DECODE = os.environ.get('RECOGNITION_DECODE', default='greedy')
+    BEAM_WIDTH = int(os.environ.get('BEAM_WIDTH', default=8))
+    BEAM_TOP_K = int(os.environ.get('BEAM_TOP_K', default=16))
+    BEAM_LM_ORDER = int(os.environ.get('BEAM_LM_ORDER', default=4))
+    BEAM_LM_WEIGHT = float(os.environ.get('BEAM_LM_WEIGHT', default=0.5))
+    # memory for decoded leaves and contour boxes kept between re-segmentations of the same page
+    PAGE_CACHE_BYTES = int(os.environ.get('PAGE_CACHE_BYTES', default=512 * 1024 ** 2))
+    # write the points-2D/<page>.jpg debug overlay on every manual re-segmentation; otherwise it is
+    # rendered on request by /segment/<manuscript>/<page>/overlay
+    SEGMENTATION_OVERLAY = os.environ.get('SEGMENTATION_OVERLAY', default='false').lower() == 'true'
+    # worker threads of the background job queue (/jobs/...); jobs share the GPU, so keep this small
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', default=1))
+    # pages recognised per step of an upload job; results are published to pollers after each step
+    JOB_RECOGNITION_CHUNK_PAGES = int(os.environ.get('JOB_RECOGNITION_CHUNK_PAGES', default=10))
+    # fine-tuning runs waiting for the (single) training worker before /fine-tune answers 429
+    FINETUNE_QUEUE_SIZE = int(os.environ.get('FINETUNE_QUEUE_SIZE', default=4))
     
\ No newline at end of file
@@ -4,6 +4,7 @@ import re
 import six
 import math
 import torch
+import torch.nn.functional as F
 import pandas  as pd
 
 from natsort import natsorted
@@ -44,7 +45,9 @@ class Batch_Balanced_Dataset(object):
         log.write(f'dataset_root: {opt.train_data}\nopt.select_data: {opt.select_data}\nopt.batch_ratio: {opt.batch_ratio}\n')
         assert len(opt.select_data) == len(opt.batch_ratio)
 
-        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, contrast_adjust = opt.contrast_adjust)
+        bucket_by_width = opt.get('bucket_by_width', False)
+        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, contrast_adjust = opt.contrast_adjust,
+                                     dynamic_width=bucket_by_width)
         self.data_loader_list = []
         self.dataloader_iter_list = []
         batch_size_list = []
@@ -74,12 +77,20 @@ class Batch_Balanced_Dataset(object):
             batch_size_list.append(str(_batch_size))
             Total_batch_size += _batch_size
 
-            _data_loader = torch.utils.data.DataLoader(
-                _dataset, batch_size=_batch_size,
-                prefetch_factor=None,
-                shuffle=True,
-                num_workers=int(opt.workers), #prefetch_factor=2,persistent_workers=True,
-                collate_fn=_AlignCollate, pin_memory=True)
+            if bucket_by_width:
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset,
+                    batch_sampler=AspectRatioBatchSampler(dataset_aspect_ratios(_dataset), _batch_size, shuffle=True),
+                    prefetch_factor=None,
+                    num_workers=int(opt.workers),
+                    collate_fn=_AlignCollate, pin_memory=True)
+            else:
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset, batch_size=_batch_size,
+                    prefetch_factor=None,
+                    shuffle=True,
+                    num_workers=int(opt.workers), #prefetch_factor=2,persistent_workers=True,
+                    collate_fn=_AlignCollate, pin_memory=True)
             self.data_loader_list.append(_data_loader)
             self.dataloader_iter_list.append(iter(_data_loader))
 
@@ -111,6 +122,12 @@ class Batch_Balanced_Dataset(object):
             except ValueError:
                 pass
 
+        # with bucket_by_width the loaders can return batches of different widths
+        max_w = max(image.size(3) for image in balanced_batch_images)
+        balanced_batch_images = [
+            F.pad(image, (0, max_w - image.size(3)), mode='replicate') if image.size(3) != max_w else image
+            for image in balanced_batch_images
+        ]
         balanced_batch_images = torch.cat(balanced_batch_images, 0)
 
         return balanced_batch_images, balanced_batch_texts
@@ -192,6 +209,71 @@ class OCRDataset(Dataset):
 
         return (img, label)
 
+    def aspect_ratio(self, index):
+        index = self.filtered_index_list[index]
+        img_fpath = os.path.join(self.root, self.df.at[index,'filename'])
+        w, h = Image.open(img_fpath).size
+        return w / float(h)
+
+
+def dataset_aspect_ratios(dataset):
+    """ width / height of every image in `dataset`, read from the image headers only """
+    if isinstance(dataset, Subset):
+        ratios = dataset_aspect_ratios(dataset.dataset)
+        return [ratios[i] for i in dataset.indices]
+    if isinstance(dataset, ConcatDataset):
+        ratios = []
+        for sub_dataset in dataset.datasets:
+            ratios += dataset_aspect_ratios(sub_dataset)
+        return ratios
+    return [dataset.aspect_ratio(index) for index in range(len(dataset))]
+
+
+class AspectRatioBatchSampler(object):
+    """
+    Batch sampler that groups images of similar aspect ratio, so that with
+    AlignCollate(dynamic_width=True) each batch is only padded to the width of
+    its own widest image instead of imgW.
+
+    Without shuffle, indices are sorted by aspect ratio and cut into batches.
+    With shuffle, indices are shuffled, sorted within buckets of `bucket_size`
+    batches and the resulting batches are shuffled, which keeps batches random
+    while still grouping similar widths.
+    """
+
+    def __init__(self, aspect_ratios, batch_size, shuffle=False, drop_last=False, bucket_size=50):
+        self.aspect_ratios = aspect_ratios
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.aspect_ratios)).tolist()
+            chunk = self.batch_size * self.bucket_size
+            buckets = [indices[i:i + chunk] for i in range(0, len(indices), chunk)]
+        else:
+            buckets = [list(range(len(self.aspect_ratios)))]
+
+        batches = []
+        for bucket in buckets:
+            bucket = sorted(bucket, key=lambda index: self.aspect_ratios[index])
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.aspect_ratios) // self.batch_size
+        return math.ceil(len(self.aspect_ratios) / self.batch_size)
+
 class ResizeNormalize(object):
 
     def __init__(self, size, interpolation=Image.BICUBIC):
@@ -228,37 +310,48 @@ class NormalizePAD(object):
 
 class AlignCollate(object):
 
-    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, contrast_adjust = 0.):
+    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, contrast_adjust = 0., dynamic_width=False):
+        """
+        dynamic_width: with keep_ratio_with_pad, pad the batch only to the widest
+            resized image in it (at most imgW) instead of always to imgW.
+            Best used together with AspectRatioBatchSampler.
+        """
         self.imgH = imgH
         self.imgW = imgW
         self.keep_ratio_with_pad = keep_ratio_with_pad
         self.contrast_adjust = contrast_adjust
+        self.dynamic_width = dynamic_width
 
     def __call__(self, batch):
         batch = filter(lambda x: x is not None, batch)
         images, labels = zip(*batch)
 
         if self.keep_ratio_with_pad:  # same concept with 'Rosetta' paper
-            resized_max_w = self.imgW
+            resized_widths = []
+            for image in images:
+                w, h = image.size
+                ratio = w / float(h)
+                if math.ceil(self.imgH * ratio) > self.imgW:
+                    resized_widths.append(self.imgW)
+                else:
+                    resized_widths.append(math.ceil(self.imgH * ratio))
+
+            if self.dynamic_width:
+                # never narrower than imgH, very short lines would vanish in the CNN's downsampling
+                resized_max_w = min(self.imgW, max(max(resized_widths), self.imgH))
+            else:
+                resized_max_w = self.imgW
             input_channel = 3 if images[0].mode == 'RGB' else 1
             transform = NormalizePAD((input_channel, self.imgH, resized_max_w))
 
             resized_images = []
-            for image in images:
-                w, h = image.size
-
+            for image, resized_w in zip(images, resized_widths):
                 #### augmentation here - change contrast
                 if self.contrast_adjust > 0:
                     image = np.array(image.convert("L"))
                     image = adjust_contrast_grey(image, target = self.contrast_adjust)
                     image = Image.fromarray(image, 'L')
 
-                ratio = w / float(h)
-                if math.ceil(self.imgH * ratio) > self.imgW:
-                    resized_w = self.imgW
-                else:
-                    resized_w = math.ceil(self.imgH * ratio)
-
                 resized_image = image.resize((resized_w, self.imgH), Image.BICUBIC)
                 resized_images.append(transform(resized_image))
                 # resized_image.save('./image_test/%d_test.jpg' % w)
@@ -2,6 +2,7 @@ import os
 import csv
 import shutil
 import random
+import tempfile
 import yaml
 import pandas as pd
 
@@ -28,7 +29,14 @@ def get_config(file_path, manuscript_name, selected_model, model_name):
     return opt
 
 
-def finetune(data):
+def finetune(data, progress_callback=None):
+    """
+    Fine-tune `selected_model` on the annotated lines in `data`.
+
+    Every run prepares its train/val split in its own temporary folder under
+    DATA_PATH/finetune, so concurrent runs never share CSVs or images.
+    progress_callback is passed on to train().
+    """
     MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
 
     manuscript_name = data[0]["manuscript_name"]
@@ -43,63 +51,68 @@ def finetune(data):
         model_name,
     )
 
-    TEMP_FOLDER = "temp"
-    TRAIN_FOLDER = os.path.join(TEMP_FOLDER, "train")
-    VAL_FOLDER = os.path.join(TEMP_FOLDER, "val")
-    TRAIN_CSV_FILE = os.path.join(TRAIN_FOLDER, "labels.csv")
-    VAL_CSV_FILE = os.path.join(VAL_FOLDER, "labels.csv")
-
-    # Ensure the temp folder exists
-    os.makedirs(TRAIN_FOLDER, exist_ok=True)
-    os.makedirs(VAL_FOLDER, exist_ok=True)
-
-    # Initialize the CSV files with headers if they don't exist
-    for csv_file in [TRAIN_CSV_FILE, VAL_CSV_FILE]:
-        if not os.path.exists(csv_file):
-            with open(csv_file, mode="w", newline="") as csvfile:
-                csvwriter = csv.writer(csvfile)
-                csvwriter.writerow(["filename", "words"])
-
-    for page in annotations:
-        for line in annotations[page]:
-            ground_truth = annotations[page][line]["ground_truth"]
-            image_path = os.path.join(
-                MANUSCRIPTS_PATH, manuscript_name, "lines", page, line + ".jpg"
-            )
-            filename = os.path.basename(image_path)
-
-            # Create log entry
-            log_entry = UserAnnotationLog(
-                manuscript_name=manuscript_name,
-                page=page,
-                line=line,
-                ground_truth=ground_truth,
-                levenshtein_distance=annotations[page][line]["levenshtein_distance"],
-                image_path=image_path,
-                timestamp=datetime.now(),
-            )
-            db.session.add(log_entry)
-
-            # Randomly assign to train or val (80% train, 20% val)
-            if random.random() < 0.8:
-                target_folder = TRAIN_FOLDER
-                target_csv = TRAIN_CSV_FILE
-            else:
-                target_folder = VAL_FOLDER
-                target_csv = VAL_CSV_FILE
-
-            # Copy the image to the appropriate folder
-            try:
-                shutil.copy(image_path, target_folder)
-            except FileNotFoundError:
-                print(f"Image not found: {image_path}")
-
-            # Append to the appropriate CSV file
-            with open(target_csv, mode="a", newline="") as csvfile:
-                csvwriter = csv.writer(csvfile)
-                csvwriter.writerow([filename, ground_truth])
-    db.session.commit()
-
-    train(opt, manuscript_name, amp=False)
-
-    shutil.rmtree("temp")
+    WORK_ROOT = os.path.join(current_app.config['DATA_PATH'], "finetune")
+    os.makedirs(WORK_ROOT, exist_ok=True)
+    TEMP_FOLDER = tempfile.mkdtemp(prefix=f"{manuscript_name}-", dir=WORK_ROOT)
+    try:
+        TRAIN_FOLDER = os.path.join(TEMP_FOLDER, "train")
+        VAL_FOLDER = os.path.join(TEMP_FOLDER, "val")
+        TRAIN_CSV_FILE = os.path.join(TRAIN_FOLDER, "labels.csv")
+        VAL_CSV_FILE = os.path.join(VAL_FOLDER, "labels.csv")
+
+        # Ensure the temp folder exists
+        os.makedirs(TRAIN_FOLDER, exist_ok=True)
+        os.makedirs(VAL_FOLDER, exist_ok=True)
+
+        # Initialize the CSV files with headers if they don't exist
+        for csv_file in [TRAIN_CSV_FILE, VAL_CSV_FILE]:
+            if not os.path.exists(csv_file):
+                with open(csv_file, mode="w", newline="") as csvfile:
+                    csvwriter = csv.writer(csvfile)
+                    csvwriter.writerow(["filename", "words"])
+
+        for page in annotations:
+            for line in annotations[page]:
+                ground_truth = annotations[page][line]["ground_truth"]
+                image_path = os.path.join(
+                    MANUSCRIPTS_PATH, manuscript_name, "lines", page, line + ".jpg"
+                )
+                filename = os.path.basename(image_path)
+
+                # Create log entry
+                log_entry = UserAnnotationLog(
+                    manuscript_name=manuscript_name,
+                    page=page,
+                    line=line,
+                    ground_truth=ground_truth,
+                    levenshtein_distance=annotations[page][line]["levenshtein_distance"],
+                    image_path=image_path,
+                    timestamp=datetime.now(),
+                )
+                db.session.add(log_entry)
+
+                # Randomly assign to train or val (80% train, 20% val)
+                if random.random() < 0.8:
+                    target_folder = TRAIN_FOLDER
+                    target_csv = TRAIN_CSV_FILE
+                else:
+                    target_folder = VAL_FOLDER
+                    target_csv = VAL_CSV_FILE
+
+                # Copy the image to the appropriate folder
+                try:
+                    shutil.copy(image_path, target_folder)
+                except FileNotFoundError:
+                    print(f"Image not found: {image_path}")
+
+                # Append to the appropriate CSV file
+                with open(target_csv, mode="a", newline="") as csvfile:
+                    csvwriter = csv.writer(csvfile)
+                    csvwriter.writerow([filename, ground_truth])
+        db.session.commit()
+
+        opt.train_data = TEMP_FOLDER
+        opt.valid_data = VAL_FOLDER
+        train(opt, manuscript_name, amp=False, progress_callback=progress_callback)
+    finally:
+        shutil.rmtree(TEMP_FOLDER, ignore_errors=True)
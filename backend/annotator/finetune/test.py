@@ -45,7 +45,6 @@ def validation(model, criterion, evaluation_loader, converter, opt, device):
             if opt.decode == 'greedy':
                 # Select max probabilty (greedy decoding) then decode index to character
                 _, preds_index = preds.max(2)
-                preds_index = preds_index.view(-1)
                 preds_str = converter.decode_greedy(preds_index.data, preds_size.data)
             elif opt.decode == 'beamsearch':
                 preds_str = converter.decode_beamsearch(preds, beamWidth=2)
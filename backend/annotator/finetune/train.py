@@ -1,5 +1,4 @@
 import os
-import sys
 import time
 import random
 import torch
@@ -12,7 +11,7 @@ from torch.cuda.amp import autocast, GradScaler
 import numpy as np
 
 from annotator.finetune.utils import CTCLabelConverter, AttnLabelConverter, Averager
-from annotator.finetune.dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset
+from annotator.finetune.dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset, AspectRatioBatchSampler, dataset_aspect_ratios
 from annotator.finetune.model import Model
 from annotator.finetune.test import validation
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -29,7 +28,11 @@ def count_parameters(model):
     print(f"Total Trainable Params: {total_params}")
     return total_params
 
-def train(opt, manuscript_name, show_number = 2, amp=False ):
+def train(opt, manuscript_name, show_number = 2, amp=False, progress_callback=None):
+    """
+    progress_callback: optional, called as progress_callback(done, total) after every
+    iteration; it may raise to stop the training early.
+    """
     """ dataset preparation """
     if not opt.data_filtering_off:
         print('Filtering the images containing characters which are not in opt.character')
@@ -40,13 +43,22 @@ def train(opt, manuscript_name, show_number = 2, amp=False ):
     train_dataset = Batch_Balanced_Dataset(opt)
 
     log = open(f'./saved_models/{opt.model_name}/log_dataset.txt', 'a', encoding="utf8")
-    AlignCollate_valid = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, contrast_adjust=opt.contrast_adjust)
+    bucket_by_width = opt.get('bucket_by_width', False)
+    AlignCollate_valid = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, contrast_adjust=opt.contrast_adjust,
+                                      dynamic_width=bucket_by_width)
     valid_dataset, valid_dataset_log = hierarchical_dataset(root=opt.valid_data, opt=opt)
-    valid_loader = torch.utils.data.DataLoader(
-        valid_dataset, batch_size=min(32, opt.batch_size),
-        shuffle=True,  # 'True' to check training progress with validation function.
-        num_workers=int(opt.workers), prefetch_factor=None,
-        collate_fn=AlignCollate_valid, pin_memory=True)
+    if bucket_by_width:
+        valid_loader = torch.utils.data.DataLoader(
+            valid_dataset,
+            batch_sampler=AspectRatioBatchSampler(dataset_aspect_ratios(valid_dataset), min(32, opt.batch_size), shuffle=True),
+            num_workers=int(opt.workers), prefetch_factor=None,
+            collate_fn=AlignCollate_valid, pin_memory=True)
+    else:
+        valid_loader = torch.utils.data.DataLoader(
+            valid_dataset, batch_size=min(32, opt.batch_size),
+            shuffle=True,  # 'True' to check training progress with validation function.
+            num_workers=int(opt.workers), prefetch_factor=None,
+            collate_fn=AlignCollate_valid, pin_memory=True)
     log.write(valid_dataset_log)
     print('-' * 80)
     log.write('-' * 80 + '\n')
@@ -276,9 +288,12 @@ def train(opt, manuscript_name, show_number = 2, amp=False ):
             torch.save(
                 model.state_dict(), f'/mnt/cai-data/manuscript-annotation-tool/models/recognition/{opt.model_name}/iter_{i+1}.pth')
 
+        if progress_callback is not None:
+            progress_callback(i + 1 - start_iter, opt.num_iter + 1 - start_iter)
+
         if i == opt.num_iter:
             print('end the training')
             del model
             torch.cuda.empty_cache()
-            sys.exit()
+            return
         i += 1
@@ -1,6 +1,9 @@
 import torch
 import pickle
 import numpy as np
+
+from annotator.recognition.beam_search import ctc_beam_search
+from annotator.recognition.utils import ctc_greedy_collapse
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 class AttrDict(dict):
@@ -256,28 +259,15 @@ class CTCLabelConverter(object):
 
     def decode_greedy(self, text_index, length):
         """ convert text-index into text-label. """
-        texts = []
-        index = 0
-        for l in length:
-            t = text_index[index:index + l]
-
-            char_list = []
-            for i in range(l):
-                if t[i] not in self.ignore_idx and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank (and separator).
-                #if (t[i] != 0) and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank (and separator).
-                    char_list.append(self.character[t[i]])
-            text = ''.join(char_list)
-
-            texts.append(text)
-            index += l
-        return texts
+        # removing repeated characters and blank (and separator).
+        return [''.join([self.character[i] for i in t]) for t in ctc_greedy_collapse(text_index, length, self.ignore_idx)]
 
     def decode_beamsearch(self, mat, beamWidth=5):
+        """ mat: model output [batch_size, T, num_class] """
         texts = []
-
-        for i in range(mat.shape[0]):
-            t = ctcBeamSearch(mat[i], self.character, self.ignore_idx, None, beamWidth=beamWidth)
-            texts.append(t)
+        for log_probs in mat.float().log_softmax(2).cpu().numpy():
+            t = ctc_beam_search(log_probs, beam_width=beamWidth)
+            texts.append(''.join([self.character[i] for i in t if i not in self.ignore_idx]))
         return texts
 
     def decode_wordbeamsearch(self, mat, beamWidth=5):
@@ -0,0 +1,73 @@
+import threading
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+# Precision, memory format and autograd mode of the CRAFT detector and the
+# recognition models at inference time. Set once from the app config in
+# create_app(), before any model is loaded.
+INFERENCE_DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+
+_options_lock = threading.Lock()
+_options = {"dtype": "float32", "channels_last": False, "inference_mode": True}
+
+
+def configure(dtype=None, channels_last=None, inference_mode=None):
+    """
+    dtype (str): "float32", or "bfloat16" to run under bf16 autocast (fast on CPUs with AVX-512 BF16/AMX).
+    channels_last (bool): keep conv weights and inputs in NHWC, which oneDNN convolutions prefer on CPU.
+    inference_mode (bool): use torch.inference_mode() instead of torch.no_grad().
+    """
+    with _options_lock:
+        if dtype is not None:
+            if dtype not in INFERENCE_DTYPES:
+                raise ValueError(f"Unsupported inference dtype {dtype!r}, expected one of {list(INFERENCE_DTYPES)}")
+            _options["dtype"] = dtype
+        if channels_last is not None:
+            _options["channels_last"] = channels_last
+        if inference_mode is not None:
+            _options["inference_mode"] = inference_mode
+
+
+def inference_options():
+    with _options_lock:
+        return dict(_options)
+
+
+def model_key():
+    """Options that change a loaded model, to be part of model cache keys."""
+    return ("channels_last", inference_options()["channels_last"])
+
+
+def prepare_model(model):
+    """Put a freshly loaded model in eval mode and in the configured memory format."""
+    model.eval()
+    if inference_options()["channels_last"]:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def prepare_input(x):
+    """Convert a batch of images (N, C, H, W) to the configured memory format."""
+    if inference_options()["channels_last"] and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+@contextmanager
+def inference_context(device, autocast=True):
+    """
+    Autograd mode and autocast for a forward pass on `device`. Outputs may be
+    bfloat16, call .float() on them before converting to numpy. Pass
+    autocast=False for models that are already quantised.
+    """
+    options = inference_options()
+    grad_mode = torch.inference_mode() if options["inference_mode"] else torch.no_grad()
+    dtype = INFERENCE_DTYPES[options["dtype"]]
+    if dtype == torch.float32 or not autocast:
+        autocast_mode = nullcontext()
+    else:
+        autocast_mode = torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+    with grad_mode, autocast_mode:
+        yield
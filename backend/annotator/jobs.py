@@ -0,0 +1,209 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been asked to stop."""
+
+
+class JobQueueFull(Exception):
+    """Raised by JobManager.submit when `max_queued` jobs are already waiting."""
+
+
+class Job(object):
+    """
+    State of one background job, shared between the worker running it and the
+    request handlers polling it.
+
+    The worker reports progress per stage with `set_progress` and publishes
+    partial results with `add_results`; both also act as cancellation points.
+    `set_timings` records how long the stages of a step took, in seconds.
+    `info` is what status requests report about the job's input, it defaults to
+    `params` (use it when the params are large, e.g. a set of annotations).
+    """
+
+    def __init__(self, kind, params, info=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.info = params if info is None else info
+        self.status = "queued"  # queued -> running -> done | failed | cancelled
+        self.stage = None
+        self.progress = OrderedDict()  # stage -> {"done": int, "total": int}
+        self._stage_started_at = {}
+        self.results = {}
+        self.timings = {}  # step -> {stage: seconds}
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def set_progress(self, stage, done, total):
+        with self._lock:
+            self.stage = stage
+            self.progress[stage] = {"done": done, "total": total}
+            self._stage_started_at.setdefault(stage, time.time())
+        self.check_cancelled()
+
+    def eta_seconds(self):
+        """Remaining time of the current stage, extrapolated from its progress so far."""
+        with self._lock:
+            if self.status != "running" or self.stage is None:
+                return None
+            counts = self.progress[self.stage]
+            if counts["done"] <= 0 or counts["total"] <= 0:
+                return None
+            elapsed = time.time() - self._stage_started_at[self.stage]
+            return elapsed / counts["done"] * (counts["total"] - counts["done"])
+
+    def set_timings(self, step, timings):
+        """Record the per-stage timings of a step, e.g. the dict returned by segment_lines()."""
+        with self._lock:
+            self.timings[step] = dict(timings)
+
+    def add_results(self, results):
+        """Publish results as soon as they are available, e.g. {page: [lines]}."""
+        with self._lock:
+            self.results.update(results)
+        self.check_cancelled()
+
+    def to_dict(self, include_results=True):
+        eta_seconds = self.eta_seconds()
+        with self._lock:
+            job = {
+                "id": self.id,
+                "kind": self.kind,
+                "params": self.info,
+                "status": self.status,
+                "stage": self.stage,
+                "progress": [dict(stage=stage, **counts) for stage, counts in self.progress.items()],
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "eta_seconds": eta_seconds,
+                "timings": {step: dict(timings) for step, timings in self.timings.items()},
+            }
+            if include_results:
+                job["results"] = dict(self.results)
+        return job
+
+
+class JobManager(object):
+    """
+    In-process job queue: jobs run on a small thread pool inside the Flask
+    process, so no external broker is needed. Job state lives in memory and is
+    lost on restart; the outputs of a job (segmented lines, recognition logs)
+    are on disk and in the database as with the synchronous endpoints.
+
+    Each job runs `fn(job, **params)` inside an application context of `app`.
+    At most `max_queued` jobs may wait for a worker (None: unbounded) and at
+    most `max_finished` finished jobs are remembered for polling.
+    """
+
+    def __init__(self, max_workers=1, max_queued=None, max_finished=100):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # id -> Job, in submission order
+        self._executor = None
+
+    def configure(self, max_workers=None, max_queued=None, max_finished=None):
+        with self._lock:
+            if max_workers is not None and max_workers != self.max_workers:
+                self.max_workers = max_workers
+                if self._executor is not None:
+                    # Already queued jobs keep running on the old pool
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+            if max_queued is not None:
+                self.max_queued = max_queued
+            if max_finished is not None:
+                self.max_finished = max_finished
+
+    def submit(self, kind, fn, params, app, info=None):
+        job = Job(kind, params, info)
+        with self._lock:
+            if self.max_queued is not None:
+                queued = sum(1 for queued_job in self._jobs.values() if queued_job.status == "queued")
+                if queued >= self.max_queued:
+                    raise JobQueueFull(f"{queued} {kind} jobs are already waiting, try again later")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="jobs")
+            self._jobs[job.id] = job
+            self._prune()
+            job.future = self._executor.submit(self._run, job, fn, app)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """Ask a job to stop. Queued jobs never start, running jobs stop at their next cancellation point."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel()
+        if job.future is not None and job.future.cancel():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+        return job
+
+    def _run(self, job, fn, app):
+        if job.cancel_requested:
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            with app.app_context():
+                fn(job, **job.params)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+
+job_manager = JobManager()
+# Fine-tuning runs one job at a time so that it never holds more than one
+# training run's worth of GPU memory next to the recognition requests.
+training_manager = JobManager(max_workers=1, max_queued=4)
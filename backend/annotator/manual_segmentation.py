@@ -6,6 +6,8 @@ import cv2
 from skimage import io
 from flask import current_app
 
+from annotator.page_cache import file_signature, load_cached_page, page_memory_cache, store_cached_page
+
 
 def gen_bounding_boxes(det, binarize_threshold):
     img = np.uint8(det)
@@ -82,73 +84,80 @@ def loadImage(img_file):
     return img
 
 
-def assign_labels_and_plot(bounding_boxes, points, labels, image, output_path="output.png"):
+def sort_points_by_row(points, labels):
     """
-    Assigns labels to given bounding boxes based on the labels of the points they contain. 
-    If a bounding box contains points with different labels (typically in tall boxes),
-    the bounding box is split maximally along the vertical direction into non-overlapping 
-    sub-boxes such that each sub-box contains points of only one label. The result is visualized 
-    by overlaying both the bounding boxes and the labeled points on the image.
+    Points and labels ordered by y (ties keep the input order), so that the points
+    of a y range are a contiguous slice found with np.searchsorted.
     """
-    import cv2
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    labels = np.asarray(labels)
+    order = np.argsort(points[:, 1], kind="stable")
+    return points[order, 0], points[order, 1], labels[order]
 
-    # Convert image to color if it is grayscale.
-    if len(image.shape) == 2:
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+def assign_labels(bounding_boxes, points, labels):
+    """
+    Assigns labels to given bounding boxes based on the labels of the points they contain.
+    If a bounding box contains points with different labels (typically in tall boxes),
+    the bounding box is split maximally along the vertical direction into non-overlapping
+    sub-boxes such that each sub-box contains points of only one label.
+    Returns the labelled boxes as (x, y, w, h, label).
+    """
+    xs, ys, row_labels = sort_points_by_row(points, labels)
 
     labeled_bboxes = []
     for bbox in bounding_boxes:
         x_min, y_min, w, h = bbox
         x_max, y_max = x_min + w, y_min + h
 
-        # Gather points (with labels) inside the bounding box.
-        pts_in_bbox = [
-            (px, py, lab)
-            for (px, py), lab in zip(points, labels)
-            if x_min <= px <= x_max and y_min <= py <= y_max
-        ]
-
-        # If all points inside have the same label, draw the original box (green).
-        if pts_in_bbox and len({lab for (_, _, lab) in pts_in_bbox}) == 1:
-            bbox_label = pts_in_bbox[0][2]
-            labeled_bboxes.append((x_min, y_min, w, h, bbox_label))
-            cv2.rectangle(image, (x_min, y_min), (x_max, y_max), (0, 255, 0), 2)
-            cv2.putText(image, str(bbox_label), (x_min, y_min - 5),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-
-        # Handle boxes with multiple labels: split maximally along the vertical axis.
-        elif pts_in_bbox:
-            # Sort points by vertical (y) coordinate.
-            pts_in_bbox.sort(key=lambda p: p[1])
-            boundaries = [y_min]
-            prev_label = pts_in_bbox[0][2]
-
-            # Compute split boundaries at label change.
-            for i in range(1, len(pts_in_bbox)):
-                current_label = pts_in_bbox[i][2]
-                if current_label != prev_label:
-                    boundary = int((pts_in_bbox[i-1][1] + pts_in_bbox[i][1]) / 2)
-                    boundary = max(boundary, y_min)
-                    boundary = min(boundary, y_max)
-                    boundaries.append(boundary)
-                    prev_label = current_label
-            boundaries.append(y_max)
-
-            # Create sub-boxes based on the computed boundaries.
-            for idx in range(1, len(boundaries)):
-                seg_top = boundaries[idx - 1]
-                seg_bottom = boundaries[idx]
-                seg_label = None
-                for (px, py, lab) in pts_in_bbox:
-                    if seg_top <= py <= seg_bottom:
-                        seg_label = lab
-                        break
-                if seg_label is not None:
-                    new_h = seg_bottom - seg_top
-                    labeled_bboxes.append((x_min, seg_top, w, new_h, seg_label))
-                    cv2.rectangle(image, (x_min, seg_top), (x_max, seg_bottom), (0, 0, 255), 2)
-                    cv2.putText(image, str(seg_label), (x_min, seg_top - 5),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+        # Gather points (with labels) inside the bounding box, sorted by y:
+        # the rows of the box, then the columns within them.
+        start = np.searchsorted(ys, y_min, side="left")
+        end = np.searchsorted(ys, y_max, side="right")
+        inside = (xs[start:end] >= x_min) & (xs[start:end] <= x_max)
+        box_ys = ys[start:end][inside]
+        box_labels = row_labels[start:end][inside]
+        if len(box_labels) == 0:
+            continue
+
+        # If all points inside have the same label, keep the original box.
+        changes = np.flatnonzero(box_labels[1:] != box_labels[:-1]) + 1
+        if len(changes) == 0:
+            labeled_bboxes.append((x_min, y_min, w, h, box_labels[0]))
+            continue
+
+        # Handle boxes with multiple labels: split maximally along the vertical axis,
+        # halfway between the two points of each label change.
+        splits = np.clip(((box_ys[changes - 1] + box_ys[changes]) / 2).astype(int), y_min, y_max)
+        boundaries = [y_min] + splits.tolist() + [y_max]
+
+        # Create sub-boxes based on the computed boundaries, labelled by their topmost point.
+        for idx in range(1, len(boundaries)):
+            seg_top = boundaries[idx - 1]
+            seg_bottom = boundaries[idx]
+            first = np.searchsorted(box_ys, seg_top, side="left")
+            if first < len(box_ys) and box_ys[first] <= seg_bottom:
+                labeled_bboxes.append((x_min, seg_top, w, seg_bottom - seg_top, box_labels[first]))
+
+    return labeled_bboxes
+
+
+def render_segmentation_overlay(image, bounding_boxes, labeled_bboxes, points, labels, output_path="output.png"):
+    """
+    Debug overlay of a manual segmentation: boxes kept whole in green, split
+    sub-boxes in red, and the labelled points, drawn over `image`.
+    """
+    # Convert image to color if it is grayscale.
+    if len(image.shape) == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    else:
+        image = image.copy()
+
+    whole_boxes = set(map(tuple, bounding_boxes))
+    for x, y, w, h, label in labeled_bboxes:
+        color = (0, 255, 0) if (x, y, w, h) in whole_boxes else (0, 0, 255)
+        cv2.rectangle(image, (x, y), (x + w, y + h), color, 2)
+        cv2.putText(image, str(label), (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
 
     # Draw all points with their labels.
     for (px, py), label in zip(points, labels):
@@ -160,6 +169,11 @@ def assign_labels_and_plot(bounding_boxes, points, labels, image, output_path="o
     cv2.imwrite(output_path, image)
     print(f"Annotated image saved as: {output_path}")
 
+
+def assign_labels_and_plot(bounding_boxes, points, labels, image, output_path="output.png"):
+    """assign_labels() and render_segmentation_overlay() in one call."""
+    labeled_bboxes = assign_labels(bounding_boxes, points, labels)
+    render_segmentation_overlay(image, bounding_boxes, labeled_bboxes, points, labels, output_path)
     return labeled_bboxes
 
 
@@ -260,11 +274,13 @@ def crop_img(img):
     return np.copy(img[row_start : row_end + 1, col_start : col_end + 1])
 
 
-def gen_line_images(img2, unique_labels, bounding_boxes):
+def gen_line_images(img2, unique_labels, bounding_boxes, background=None):
     # change here
     #   global lineheight_baseline_percentile
     line_images = []
     pad = 5
+    if background is None:
+        background = np.median(img2)
     for l in unique_labels:
         # Filter bounding boxes for the current label
         filtered_boxes = [box for box in bounding_boxes if box[4] == l]
@@ -280,9 +296,7 @@ def gen_line_images(img2, unique_labels, bounding_boxes):
         )  # 5 pixels padding top and bottom
         miny = min(y for _, y, _, _, _ in filtered_boxes)
         # Create an empty image for this label
-        new_img = np.ones((max_height, total_width), dtype=np.uint8) * np.int32(
-            np.median(img2)
-        )
+        new_img = np.ones((max_height, total_width), dtype=np.uint8) * np.int32(background)
 
         for box in filtered_boxes:
             x, y, w, h, l = box
@@ -293,46 +307,128 @@ def gen_line_images(img2, unique_labels, bounding_boxes):
     return line_images
 
 
-def run_manual_segmentation(manuscript_name, page):
+def page_paths(manuscript_name, page):
     BASE_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
-    IMAGE_FILEPATH = os.path.join(BASE_PATH, manuscript_name, "leaves", f"{page}.jpg")
-    HEATMAP_FILEPATH = os.path.join(BASE_PATH, manuscript_name, "heatmaps", f"{page}.jpg")
-    POINTS_FILEPATH = os.path.join(BASE_PATH, manuscript_name, "points-2D", f"{page}_points.txt")
-    LABELS_FILEPATH = os.path.join(BASE_PATH, manuscript_name, "points-2D", f"{page}_labels.txt")
-    LINES_DIR = os.path.join(BASE_PATH, manuscript_name, "lines", page)
+    return {
+        "manuscript": os.path.join(BASE_PATH, manuscript_name),
+        "image": os.path.join(BASE_PATH, manuscript_name, "leaves", f"{page}.jpg"),
+        "heatmap": os.path.join(BASE_PATH, manuscript_name, "heatmaps", f"{page}.jpg"),
+        "points": os.path.join(BASE_PATH, manuscript_name, "points-2D", f"{page}_points.txt"),
+        "labels": os.path.join(BASE_PATH, manuscript_name, "points-2D", f"{page}_labels.txt"),
+        "overlay": os.path.join(BASE_PATH, manuscript_name, "points-2D", f"{page}.jpg"),
+        "lines": os.path.join(BASE_PATH, manuscript_name, "lines", page),
+        "manifests": os.path.join(BASE_PATH, manuscript_name, "line-manifests"),
+    }
+
+
+def load_page_regions(paths, binarize_threshold=100):
+    """
+    The grayscale leaf at heatmap resolution (half the leaf size) and the
+    bounding boxes of the binarised heatmap's contours.
+
+    Both are kept in page_memory_cache until the leaf or the heatmap changes,
+    so that repeated re-segmentations of a page only decode them once. The
+    returned image is read-only.
+    """
+    def _load():
+        image = loadImage(paths["image"])
+        det = loadImage(paths["heatmap"])
 
-    binarize_threshold = 100
+        det = det.squeeze()
+        if len(det.shape) == 3:
+            det = det[:, :, 0]  # Keep only one channel
 
-    image = loadImage(IMAGE_FILEPATH)
-    det = loadImage(HEATMAP_FILEPATH)
-    filtered_points, filtered_labels = load_points_and_labels(POINTS_FILEPATH, LABELS_FILEPATH)
+        #print(image.shape) this is x2 scale
+        img2 = cv2.cvtColor(cv2.resize(image, det.shape[::-1]), cv2.COLOR_BGR2GRAY)
+        return img2, gen_bounding_boxes(det, binarize_threshold)
 
-    det = det.squeeze()
-    print(det.shape)
-    if len(det.shape) == 3:  
-        det = det[:, :, 0]  # Keep only one channel
-    print(det.shape)
+    key = ("page-regions", os.path.abspath(paths["image"]), binarize_threshold)
+    return page_memory_cache.get(key, [paths["image"], paths["heatmap"]], _load)
 
-    #print(image.shape) this is x2 scale
-    img2 = cv2.cvtColor(cv2.resize(image, det.shape[::-1]), cv2.COLOR_BGR2GRAY) 
 
+def render_page_overlay(manuscript_name, page):
+    """
+    Path of the debug overlay of a page's manual segmentation (points-2D/<page>.jpg),
+    rendered only if it is missing or older than the labels, points, leaf or heatmap.
+    """
+    paths = page_paths(manuscript_name, page)
+    sources = [paths["image"], paths["heatmap"], paths["points"], paths["labels"]]
+    if os.path.exists(paths["overlay"]) and \
+            os.path.getmtime(paths["overlay"]) >= max(os.path.getmtime(path) for path in sources):
+        return paths["overlay"]
+
+    img2, bounding_boxes = load_page_regions(paths)
+    filtered_points, filtered_labels = load_points_and_labels(paths["points"], paths["labels"])
+    labeled_bboxes = assign_labels(bounding_boxes, filtered_points, filtered_labels)
+    render_segmentation_overlay(img2, bounding_boxes, labeled_bboxes, filtered_points, filtered_labels, paths["overlay"])
+    return paths["overlay"]
 
-    bounding_boxes = gen_bounding_boxes(det, binarize_threshold)
-    labeled_bboxes = assign_labels_and_plot(bounding_boxes, filtered_points, filtered_labels, img2, output_path=os.path.join(BASE_PATH, manuscript_name, "points-2D", f"{page}.jpg"))
 
-    # Sort by the numeric label (5th element)
-    # sorted_bboxes = sorted(labeled_bboxes, key=lambda x: x[4])
+def update_line_images(paths, page, img2, labeled_bboxes):
+    """
+    Write the line images of a page, one per label in sorted label order
+    (line001.jpg, ...). Lines used to be numbered in the iteration order of the
+    label set, which is not sorted for sparse labels ({3, 9} iterates 9 first),
+    so the numbering of such pages may change once when they are re-segmented.
+
+    The boxes of each line are kept in a manifest (line-manifests/<page>.json),
+    and a line whose boxes did not change since the last call keeps its image.
+    All lines are rewritten when the leaf or the heatmap changed. Returns the
+    names of the lines written or removed.
+    """
+    LINES_DIR = paths["lines"]
+    key = {"leaf": file_signature(paths["image"]), "heatmap": file_signature(paths["heatmap"])}
+    previous = load_cached_page(paths["manifests"], page, key)
+    if previous is None:
+        shutil.rmtree(LINES_DIR, ignore_errors=True)
+        previous = {}
+    os.makedirs(LINES_DIR, exist_ok=True)
+
+    boxes_of_label = {}
+    for box in labeled_bboxes:
+        boxes_of_label.setdefault(box[4], []).append([int(v) for v in box[:4]])
+    lines = {f"line{i+1:03d}": label for i, label in enumerate(sorted(boxes_of_label))}
+
+    background = np.median(img2)
+    changed = []
+    for line_name, label in lines.items():
+        line_path = os.path.join(LINES_DIR, f"{line_name}.jpg")
+        if previous.get(line_name) == boxes_of_label[label] and os.path.exists(line_path):
+            continue
+        (line_image,) = gen_line_images(img2, [label], labeled_bboxes, background)
+        cv2.imwrite(line_path, line_image)
+        changed.append(line_name)
+
+    for line_name in previous:
+        if line_name not in lines:
+            line_path = os.path.join(LINES_DIR, f"{line_name}.jpg")
+            if os.path.exists(line_path):
+                os.remove(line_path)
+            changed.append(line_name)
 
-    # Get unique labels
-    unique_labels = set(label for _, _, _, _, label in labeled_bboxes)
-    print(unique_labels)
-    line_images = gen_line_images(img2,unique_labels,labeled_bboxes)
+    store_cached_page(paths["manifests"], page, key, {
+        line_name: boxes_of_label[label] for line_name, label in lines.items()
+    })
+    return changed
 
-    shutil.rmtree(LINES_DIR)
-    os.makedirs(LINES_DIR)
 
-    for i in range(len(line_images)):
-        cv2.imwrite(os.path.join(LINES_DIR, f"line{i+1:03d}.jpg"),line_images[i])
+def run_manual_segmentation(manuscript_name, page):
+    """
+    Regenerate the line images of a page from its labelled points. Only lines
+    whose boxes changed are rewritten. Returns the names of the lines written or removed.
+    """
+    paths = page_paths(manuscript_name, page)
+
+    img2, bounding_boxes = load_page_regions(paths)
+    filtered_points, filtered_labels = load_points_and_labels(paths["points"], paths["labels"])
+    labeled_bboxes = assign_labels(bounding_boxes, filtered_points, filtered_labels)
+    # the debug overlay is otherwise rendered on request, see render_page_overlay()
+    if current_app.config['SEGMENTATION_OVERLAY']:
+        render_segmentation_overlay(img2, bounding_boxes, labeled_bboxes, filtered_points, filtered_labels, paths["overlay"])
+
+    changed = update_line_images(paths, page, img2, labeled_bboxes)
+    print(f"lines regenerated for page {page}: {changed}")
+    return changed
 
 
 
@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+def file_hash(path):
+    """sha1 of the file contents"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_signature(path):
+    """Cheap change marker for large files (e.g. leaf images): mtime and size."""
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def load_cached_page(cache_dir, page, key):
+    """
+    Return the data cached for `page` if it was stored under the same `key`, else None.
+
+    key (dict): signatures of the files the cached data was computed from.
+    """
+    cache_path = os.path.join(cache_dir, f"{page}.json")
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached["data"]
+
+
+def store_cached_page(cache_dir, page, key, data):
+    """Cache `data` for `page` under `key`, replacing any previous entry atomically."""
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{page}.json")
+    tmp_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"key": key, "data": data}, f)
+    os.replace(tmp_path, cache_path)
+
+
+# Scales at which leaf previews can be requested, relative to the leaf image
+PREVIEW_SCALES = (0.25, 0.5, 1.0)
+
+
+def leaf_preview(leaf_path, preview_dir, page, scale, quality=85):
+    """
+    Return the path of the JPEG preview of `leaf_path` at `scale`.
+
+    Previews are generated once and kept in `preview_dir`; a preview older than
+    its leaf image is regenerated.
+    """
+    preview_path = os.path.join(preview_dir, f"{page}_{int(scale * 100)}.jpg")
+    if os.path.exists(preview_path) and os.stat(preview_path).st_mtime_ns >= os.stat(leaf_path).st_mtime_ns:
+        return preview_path
+
+    os.makedirs(preview_dir, exist_ok=True)
+    tmp_path = f"{preview_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with Image.open(leaf_path) as image:
+        width, height = image.size
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if scale != 1.0:
+            image = image.resize((int(width * scale), int(height * scale)), Image.BILINEAR)
+        image.save(tmp_path, format="JPEG", quality=quality)
+    os.replace(tmp_path, preview_path)
+    return preview_path
+
+
+class PageMemoryCache(object):
+    """
+    In-memory LRU cache of data decoded from the files of a page, e.g. the
+    grayscale leaf and the contour boxes used by manual re-segmentation.
+
+    Entries are validated against the signatures of their source files, so an
+    entry is recomputed after any of them changed on disk. The cache holds at
+    most `max_bytes` bytes of arrays; the least recently used entry is evicted
+    first. Cached arrays are read-only and shared between requests.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (signatures, data, size in bytes)
+
+    def configure(self, max_bytes=None):
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key, sources, load_fn):
+        """
+        Return the data cached under `key`, calling `load_fn()` to compute it on a
+        miss or if one of the `sources` files changed.
+
+        load_fn: returns a tuple of numpy arrays and other (small) values.
+        """
+        signatures = tuple(file_signature(path) for path in sources)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signatures:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        # Compute outside the lock so a slow decode does not block other pages.
+        data = load_fn()
+        for value in data:
+            if hasattr(value, "flags"):
+                value.flags.writeable = False
+        size = sum(getattr(value, "nbytes", 0) for value in data)
+
+        with self._lock:
+            self._entries[key] = (signatures, data, size)
+            self._entries.move_to_end(key)
+            self._evict()
+        return data
+
+    def invalidate(self, key=None):
+        """Drop every entry, or only the one under `key`."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _evict(self):
+        while self._entries and sum(size for _, _, size in self._entries.values()) > self.max_bytes:
+            self._entries.popitem(last=False)
+
+
+page_memory_cache = PageMemoryCache()
@@ -0,0 +1,152 @@
+"""
+CTC prefix beam search over the log-probabilities of the recognition model,
+with an optional character n-gram language model.
+
+Prefixes are nodes of a trie, so extending a beam by one character is a dict
+lookup and beams that reach the same text share one node. The scores of all
+beams are kept in arrays and, at every frame, only the `top_k` most likely
+characters are considered as extensions.
+"""
+import numpy as np
+
+
+NEG_INF = -np.inf
+BOS = -1  # context padding at the start of a line
+
+
+class CharNgramLM:
+    """
+    Character n-gram model over the class indices of a recognition charset,
+    with Witten-Bell interpolation down to an add-one unigram.
+
+    character (str): charset of the model, as given to CTCLabelConverter: class
+        index i + 1 is character[i], index 0 being the CTC blank.
+    texts (iterable of str): training text, characters outside `character` are skipped.
+    """
+
+    def __init__(self, character, texts, order=4):
+        self.order = order
+        self.num_class = len(character) + 1
+        self.index = {char: i + 1 for i, char in enumerate(character)}
+        # counts[n][context of n indices] -> counts of the next index
+        self.counts = [{} for _ in range(order)]
+        self._cache = {}
+
+        for text in texts:
+            indices = [self.index[char] for char in text if char in self.index]
+            history = [BOS] * (order - 1) + indices
+            for position, label in enumerate(indices):
+                for n in range(order):
+                    context = tuple(history[position + order - 1 - n:position + order - 1])
+                    counts = self.counts[n].get(context)
+                    if counts is None:
+                        counts = self.counts[n][context] = np.zeros(self.num_class)
+                    counts[label] += 1
+
+    def next_log_probs(self, context):
+        """log P(index | context) for every class index; `context` is a tuple of the previous indices."""
+        context = tuple(context[-(self.order - 1):]) if self.order > 1 else ()
+        context = (BOS,) * (self.order - 1 - len(context)) + context
+        log_probs = self._cache.get(context)
+        if log_probs is None:
+            log_probs = self._cache[context] = np.log(self._probs(context))
+        return log_probs
+
+    def _probs(self, context):
+        unigram = self.counts[0].get((), np.zeros(self.num_class))
+        probs = (unigram + 1) / (unigram.sum() + self.num_class - 1)
+        for n in range(1, self.order):
+            counts = self.counts[n].get(context[len(context) - n:])
+            if counts is None:
+                break
+            total, types = counts.sum(), np.count_nonzero(counts)
+            probs = (counts + types * probs) / (total + types)
+        probs[0] = 1.0  # never scored: blanks do not extend a prefix
+        return probs
+
+
+class _Prefix:
+    """A node of the prefix trie: the text decoded so far."""
+
+    __slots__ = ("parent", "label", "children", "labels", "lm_score")
+
+    def __init__(self, parent=None, label=None, lm_score=0.0):
+        self.parent = parent
+        self.label = label
+        self.children = {}
+        self.labels = () if parent is None else parent.labels + (label,)
+        self.lm_score = lm_score
+
+    def child(self, label, lm_score):
+        node = self.children.get(label)
+        if node is None:
+            node = self.children[label] = _Prefix(self, label, self.lm_score + lm_score)
+        return node
+
+
+def ctc_beam_search(log_probs, beam_width=8, top_k=16, lm=None, lm_weight=0.5, length_bonus=0.0):
+    """
+    Decode one line.
+
+    log_probs (ndarray): [T, num_class] log-softmax output of the model, index 0 being the CTC blank.
+    beam_width (int): prefixes kept after each frame.
+    top_k (int): characters considered as extensions at each frame.
+    lm (CharNgramLM): optional language model, weighted by `lm_weight`;
+        `length_bonus` is added per character to balance its cost.
+
+    Returns the class indices of the best prefix.
+    """
+    num_class = log_probs.shape[1]
+    top_k = min(top_k, num_class - 1)
+    root = _Prefix()
+    beams = [root]
+    p_blank = np.array([0.0])
+    p_label = np.array([NEG_INF])
+
+    for frame in log_probs:
+        # most likely non-blank characters of this frame
+        candidates = np.argpartition(-frame[1:], top_k - 1)[:top_k] + 1 if top_k > 0 else np.empty(0, dtype=int)
+        p_total = np.logaddexp(p_blank, p_label)
+
+        # [beam, candidate]: a repeated character needs a blank in between to count twice
+        last = np.array([NEG_INF if node.label is None else node.label for node in beams])
+        repeat = candidates[None, :] == last[:, None]
+        extend = np.where(repeat, p_blank[:, None], p_total[:, None]) + frame[candidates][None, :]
+        if lm is not None:
+            lm_scores = np.stack([
+                lm_weight * lm.next_log_probs(node.labels)[candidates] + length_bonus for node in beams
+            ])
+        else:
+            lm_scores = np.full(extend.shape, length_bonus)
+        ranked = extend + lm_scores + np.array([node.lm_score for node in beams])[:, None]
+
+        # keep the best beam_width extensions, and every extension that lands on a current beam
+        keep = np.zeros(extend.shape, dtype=bool)
+        flat = ranked.ravel()
+        best = np.argpartition(-flat, min(beam_width, flat.size) - 1)[:beam_width]
+        keep.flat[best] = np.isfinite(flat[best])
+        position = {node: i for i, node in enumerate(beams)}
+        candidate_column = {label: j for j, label in enumerate(candidates.tolist())}
+        for node in beams:
+            if node.parent in position and node.label in candidate_column:
+                keep[position[node.parent], candidate_column[node.label]] = True
+
+        next_blank, next_label = {}, {}
+        for i, node in enumerate(beams):
+            # stay on the same prefix: emit a blank, or repeat the last character
+            next_blank[node] = p_total[i] + frame[0]
+            if node.label is not None:
+                next_label[node] = p_label[i] + frame[node.label]
+        for i, j in zip(*np.nonzero(keep)):
+            child = beams[i].child(int(candidates[j]), lm_scores[i, j])
+            next_label[child] = np.logaddexp(next_label.get(child, NEG_INF), extend[i, j])
+
+        nodes = list(next_blank) + [node for node in next_label if node not in next_blank]
+        p_blank = np.array([next_blank.get(node, NEG_INF) for node in nodes])
+        p_label = np.array([next_label.get(node, NEG_INF) for node in nodes])
+        scores = np.logaddexp(p_blank, p_label) + np.array([node.lm_score for node in nodes])
+        order = np.argsort(-scores, kind="stable")[:beam_width]
+        beams = [nodes[i] for i in order]
+        p_blank, p_label = p_blank[order], p_label[order]
+
+    return list(beams[0].labels)
@@ -221,14 +221,20 @@ class LmdbDataset(Dataset):
 class RawDataset(Dataset):
 
     def __init__(self, root, opt):
+        """ root: a folder, or a list of folders (searched recursively for images) and image files """
         self.opt = opt
         self.image_path_list = []
-        for dirpath, dirnames, filenames in os.walk(root):
-            for name in filenames:
-                _, ext = os.path.splitext(name)
-                ext = ext.lower()
-                if ext == '.jpg' or ext == '.jpeg' or ext == '.png':
-                    self.image_path_list.append(os.path.join(dirpath, name))
+        roots = [root] if isinstance(root, str) else root
+        for folder in roots:
+            if os.path.isfile(folder):
+                self.image_path_list.append(folder)
+                continue
+            for dirpath, dirnames, filenames in os.walk(folder):
+                for name in filenames:
+                    _, ext = os.path.splitext(name)
+                    ext = ext.lower()
+                    if ext == '.jpg' or ext == '.jpeg' or ext == '.png':
+                        self.image_path_list.append(os.path.join(dirpath, name))
 
         self.image_path_list = natsorted(self.image_path_list)
         self.nSamples = len(self.image_path_list)
@@ -254,6 +260,72 @@ class RawDataset(Dataset):
 
         return (img, self.image_path_list[index])
 
+    def aspect_ratio(self, index):
+        try:
+            w, h = Image.open(self.image_path_list[index]).size
+        except IOError:
+            w, h = self.opt.imgW, self.opt.imgH
+        return w / float(h)
+
+
+def dataset_aspect_ratios(dataset):
+    """ width / height of every image in `dataset`, read from the image headers only """
+    if isinstance(dataset, Subset):
+        ratios = dataset_aspect_ratios(dataset.dataset)
+        return [ratios[i] for i in dataset.indices]
+    if isinstance(dataset, ConcatDataset):
+        ratios = []
+        for sub_dataset in dataset.datasets:
+            ratios += dataset_aspect_ratios(sub_dataset)
+        return ratios
+    return [dataset.aspect_ratio(index) for index in range(len(dataset))]
+
+
+class AspectRatioBatchSampler(object):
+    """
+    Batch sampler that groups images of similar aspect ratio, so that with
+    AlignCollate(dynamic_width=True) each batch is only padded to the width of
+    its own widest image instead of imgW.
+
+    Without shuffle, indices are sorted by aspect ratio and cut into batches.
+    With shuffle, indices are shuffled, sorted within buckets of `bucket_size`
+    batches and the resulting batches are shuffled, which keeps batches random
+    while still grouping similar widths.
+    """
+
+    def __init__(self, aspect_ratios, batch_size, shuffle=False, drop_last=False, bucket_size=50):
+        self.aspect_ratios = aspect_ratios
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.aspect_ratios)).tolist()
+            chunk = self.batch_size * self.bucket_size
+            buckets = [indices[i:i + chunk] for i in range(0, len(indices), chunk)]
+        else:
+            buckets = [list(range(len(self.aspect_ratios)))]
+
+        batches = []
+        for bucket in buckets:
+            bucket = sorted(bucket, key=lambda index: self.aspect_ratios[index])
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.aspect_ratios) // self.batch_size
+        return math.ceil(len(self.aspect_ratios) / self.batch_size)
+
 
 class ResizeNormalize(object):
 
@@ -291,29 +363,41 @@ class NormalizePAD(object):
 
 class AlignCollate(object):
 
-    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False):
+    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, dynamic_width=False):
+        """
+        dynamic_width: with keep_ratio_with_pad, pad the batch only to the widest
+            resized image in it (at most imgW) instead of always to imgW.
+            Best used together with AspectRatioBatchSampler.
+        """
         self.imgH = imgH
         self.imgW = imgW
         self.keep_ratio_with_pad = keep_ratio_with_pad
+        self.dynamic_width = dynamic_width
 
     def __call__(self, batch):
         batch = filter(lambda x: x is not None, batch)
         images, labels = zip(*batch)
 
         if self.keep_ratio_with_pad:  # same concept with 'Rosetta' paper
-            resized_max_w = self.imgW
-            input_channel = 3 if images[0].mode == 'RGB' else 1
-            transform = NormalizePAD((input_channel, self.imgH, resized_max_w))
-
-            resized_images = []
+            resized_widths = []
             for image in images:
                 w, h = image.size
                 ratio = w / float(h)
                 if math.ceil(self.imgH * ratio) > self.imgW:
-                    resized_w = self.imgW
+                    resized_widths.append(self.imgW)
                 else:
-                    resized_w = math.ceil(self.imgH * ratio)
+                    resized_widths.append(math.ceil(self.imgH * ratio))
 
+            if self.dynamic_width:
+                # never narrower than imgH, very short lines would vanish in the CNN's downsampling
+                resized_max_w = min(self.imgW, max(max(resized_widths), self.imgH))
+            else:
+                resized_max_w = self.imgW
+            input_channel = 3 if images[0].mode == 'RGB' else 1
+            transform = NormalizePAD((input_channel, self.imgH, resized_max_w))
+
+            resized_images = []
+            for image, resized_w in zip(images, resized_widths):
                 resized_image = image.resize((resized_w, self.imgH), Image.BICUBIC)
                 resized_images.append(transform(resized_image))
                 # resized_image.save('./image_test/%d_test.jpg' % w)
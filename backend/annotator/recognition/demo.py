@@ -5,8 +5,11 @@ import torch.utils.data
 import torch.nn.functional as F
 
 from annotator.recognition.utils import CTCLabelConverter, AttnLabelConverter
-from annotator.recognition.dataset import RawDataset, AlignCollate
-from annotator.recognition.model import Model
+from annotator.recognition.dataset import RawDataset, AlignCollate, AspectRatioBatchSampler
+from annotator.recognition.model_cache import model_cache
+from annotator.recognition.export import build_model, is_quantized, is_quantized_checkpoint, load_quantized
+from annotator.recognition.torchscript import is_torchscript, load_torchscript
+from annotator.inference import inference_context, model_key, prepare_input, prepare_model
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -15,7 +18,36 @@ class OCRConfig:
         self.__dict__.update(kwargs)
 
 
-def recognise_lines(
+ARCHITECTURE_OPTIONS = (
+    "Transformation", "FeatureExtraction", "SequenceModeling", "Prediction",
+    "imgH", "imgW", "num_fiducial", "input_channel", "output_channel",
+    "hidden_size", "num_class", "batch_max_length",
+)
+
+
+def load_model(opt):
+    """
+    Return the recognition model for `opt.saved_model`, loading it only if it is
+    not already in the model cache.
+    """
+    def _load():
+        print(f"Loading pretrained model from {opt.saved_model}")
+        if is_torchscript(opt.saved_model):
+            # traced artifacts written by recognition.export; opt must come from their meta.json
+            model, _ = load_torchscript(opt.saved_model, device)
+            return prepare_model(model)
+        if is_quantized_checkpoint(opt.saved_model):
+            # int8 variants written by recognition.export, CPU only
+            return prepare_model(load_quantized(opt.saved_model, opt))
+        model = build_model(opt).to(device)
+        model.load_state_dict(torch.load(opt.saved_model, map_location="cpu"))
+        return prepare_model(model)
+
+    options = tuple(getattr(opt, name) for name in ARCHITECTURE_OPTIONS) + model_key()
+    return model_cache.get(opt.saved_model, options, _load)
+
+
+def make_config(
     image_folder,
     saved_model,
     transformation,
@@ -37,33 +69,9 @@ def recognise_lines(
     hidden_size=256,
 ):
     """
-    Recognise text lines from images in the specified folder using the specified model.
-
-    Parameters:
-        image_folder (str): Path to the folder containing images.
-        saved_model (str): Path to the pretrained model.
-        transformation (str): Transformation stage. Options: None, TPS.
-        feature_extraction (str): Feature extraction stage. Options: VGG, RCNN, ResNet.
-        sequence_modeling (str): Sequence modeling stage. Options: None, BiLSTM.
-        prediction (str): Prediction stage. Options: CTC, Attn.
-        batch_size (int): Batch size for processing images.
-        workers (int): Number of workers for data loading.
-        batch_max_length (int): Maximum label length.
-        imgH (int): Height of input images.
-        imgW (int): Width of input images.
-        rgb (bool): Whether to use RGB input.
-        character (str): Character set for labels.
-        sensitive (bool): Use sensitive character mode.
-        pad (bool): Whether to pad resized images to maintain aspect ratio.
-        num_fiducial (int): Number of fiducial points for TPS-STN.
-        input_channel (int): Number of input channels for the feature extractor.
-        output_channel (int): Number of output channels for the feature extractor.
-        hidden_size (int): Size of the LSTM hidden state.
-
-    Returns:
-        results (list): List of dictionaries containing image paths, predicted labels, and confidence scores.
+    Build the model options and the label converter for the given architecture
+    (see recognise_lines for the parameters). Returns (opt, converter).
     """
-
     # Configure the character set
     if sensitive:
         character = string.printable[:-6] if character is None else character
@@ -103,47 +111,136 @@ def recognise_lines(
         num_class=num_class,
     )
 
-    # Load the model
-    model = Model(opt)
-    model = torch.nn.DataParallel(model).to(device)
+    return opt, converter
+
+
+def recognise_lines(
+    image_folder,
+    saved_model,
+    transformation,
+    feature_extraction,
+    sequence_modeling,
+    prediction,
+    batch_size=192,
+    workers=4,
+    batch_max_length=25,
+    imgH=32,
+    imgW=100,
+    rgb=False,
+    character=None,
+    sensitive=False,
+    pad=False,
+    num_fiducial=20,
+    input_channel=1,
+    output_channel=512,
+    hidden_size=256,
+    bucket_by_width=False,
+    decode="greedy",
+    beam_width=8,
+    beam_top_k=16,
+    lm=None,
+    lm_weight=0.5,
+):
+    """
+    Recognise text lines from images in the specified folder using the specified model.
+
+    Parameters:
+        image_folder (str or list): Path to the folder containing images, or a list of such folders and image files.
+        saved_model (str): Path to the pretrained model.
+        transformation (str): Transformation stage. Options: None, TPS.
+        feature_extraction (str): Feature extraction stage. Options: VGG, RCNN, ResNet.
+        sequence_modeling (str): Sequence modeling stage. Options: None, BiLSTM.
+        prediction (str): Prediction stage. Options: CTC, Attn.
+        batch_size (int): Batch size for processing images.
+        workers (int): Number of workers for data loading.
+        batch_max_length (int): Maximum label length.
+        imgH (int): Height of input images.
+        imgW (int): Width of input images.
+        rgb (bool): Whether to use RGB input.
+        character (str): Character set for labels.
+        sensitive (bool): Use sensitive character mode.
+        pad (bool): Whether to pad resized images to maintain aspect ratio.
+        num_fiducial (int): Number of fiducial points for TPS-STN.
+        input_channel (int): Number of input channels for the feature extractor.
+        output_channel (int): Number of output channels for the feature extractor.
+        hidden_size (int): Size of the LSTM hidden state.
+        bucket_by_width (bool): Batch lines of similar aspect ratio together and pad each batch
+            only to its own widest line instead of imgW. Results keep the dataset order.
+        decode (str): CTC decoding. Options: greedy, beamsearch.
+        beam_width (int): Prefixes kept per frame by the beam search.
+        beam_top_k (int): Characters considered per frame by the beam search.
+        lm (CharNgramLM): Character n-gram model used by the beam search, or None.
+        lm_weight (float): Weight of the language model score.
+
+    Returns:
+        results (list): List of dictionaries containing image paths, predicted labels, and confidence scores.
+    """
+
+    if decode not in ("greedy", "beamsearch"):
+        raise ValueError(f"Unsupported decode mode {decode!r}, expected greedy or beamsearch")
+    if decode == "beamsearch" and "CTC" not in prediction:
+        raise ValueError("Beam search decoding needs a CTC model")
+
+    opt, converter = make_config(
+        image_folder, saved_model, transformation, feature_extraction, sequence_modeling, prediction,
+        batch_size, workers, batch_max_length, imgH, imgW, rgb, character, sensitive, pad,
+        num_fiducial, input_channel, output_channel, hidden_size,
+    )
 
-    print(f"Loading pretrained model from {saved_model}")
-    model.load_state_dict(torch.load(saved_model, map_location=device))
+    # Load the model (shared through the model cache)
+    model = load_model(opt)
+    quantized = is_quantized(model)
+    model_device = torch.device("cpu") if quantized else device
 
     # Prepare data loader
-    AlignCollate_demo = AlignCollate(imgH=imgH, imgW=imgW, keep_ratio_with_pad=pad)
+    AlignCollate_demo = AlignCollate(imgH=imgH, imgW=imgW, keep_ratio_with_pad=pad, dynamic_width=bucket_by_width)
     demo_data = RawDataset(root=image_folder, opt=opt)  # Use RawDataset
-    demo_loader = torch.utils.data.DataLoader(
-        demo_data,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=workers,
-        collate_fn=AlignCollate_demo,
-        pin_memory=True,
-    )
+    if bucket_by_width:
+        aspect_ratios = [demo_data.aspect_ratio(index) for index in range(len(demo_data))]
+        demo_loader = torch.utils.data.DataLoader(
+            demo_data,
+            batch_sampler=AspectRatioBatchSampler(aspect_ratios, batch_size),
+            num_workers=workers,
+            collate_fn=AlignCollate_demo,
+            pin_memory=True,
+        )
+    else:
+        demo_loader = torch.utils.data.DataLoader(
+            demo_data,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=workers,
+            collate_fn=AlignCollate_demo,
+            pin_memory=True,
+        )
 
     # Perform prediction
-    model.eval()
     results = []
-    with torch.no_grad():
+    with inference_context(model_device, autocast=not quantized):
         for image_tensors, image_path_list in demo_loader:
             batch_size = image_tensors.size(0)
-            image = image_tensors.to(device)
+            image = prepare_input(image_tensors.to(model_device))
             length_for_pred = torch.IntTensor([batch_max_length] * batch_size).to(
-                device
+                model_device
             )
             text_for_pred = (
-                torch.LongTensor(batch_size, batch_max_length + 1).fill_(0).to(device)
+                torch.LongTensor(batch_size, batch_max_length + 1).fill_(0).to(model_device)
             )
 
             if "CTC" in prediction:
-                preds = model(image, text_for_pred)
+                preds = model(image, text_for_pred).float()
                 preds_size = torch.IntTensor([preds.size(1)] * batch_size)
-                _, preds_index = preds.max(2)
-                preds_str = converter.decode(preds_index, preds_size)
-                del preds_size, preds_index
+                if decode == "beamsearch":
+                    preds_str = converter.decode_beamsearch(
+                        preds.log_softmax(2), beam_width=beam_width, top_k=beam_top_k, lm=lm, lm_weight=lm_weight
+                    )
+                else:
+                    _, preds_index = preds.max(2)
+                    preds_str = converter.decode(preds_index, preds_size)
+                    del preds_index
+                del preds_size
             else:
-                preds = model(image, text_for_pred, is_train=False)
+                preds = model(image, text_for_pred, is_train=False).float()
                 _, preds_index = preds.max(2)
                 preds_str = converter.decode(preds_index, length_for_pred)
 
@@ -172,7 +269,12 @@ def recognise_lines(
             torch.cuda.empty_cache()
 
     
-    # clear GPU memory
+    if bucket_by_width:
+        # batches were formed out of order, restore the dataset order
+        order = {path: index for index, path in enumerate(demo_data.image_path_list)}
+        results.sort(key=lambda result: order[result["image_path"]])
+
+    # clear GPU memory (the model itself stays in the model cache)
     del model
     del demo_loader, AlignCollate_demo, demo_data
     torch.cuda.empty_cache()
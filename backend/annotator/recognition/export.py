@@ -0,0 +1,186 @@
+"""
+Export trained recognition checkpoints into deployment variants that are
+stored next to them in models/recognition:
+
+    <name>.int8.pth          dynamic int8 quantisation of the BiLSTMs and the
+                             CTC Linear, for CPU-only inference
+    <name>.torchscript.pt    traced TorchScript model with its architecture
+                             options and charset embedded (see torchscript.py)
+
+Run from the backend directory:
+
+    python -m annotator.recognition.export instance/models/recognition/<model>.pth [--format torchscript]
+"""
+import argparse
+import json
+import os
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+from annotator.recognition.torchscript import META_FILE, TORCHSCRIPT_FORMAT, TORCHSCRIPT_SUFFIX
+
+
+QUANTIZED_FORMAT = "dynamic-int8"
+QUANTIZED_SUFFIX = ".int8.pth"
+
+
+def build_model(opt):
+    """
+    The eager model for `opt`, wrapped in DataParallel like the trained checkpoints.
+
+    recognition.model (and through it recognition/modules) is only imported
+    here, so that TorchScript artifacts load and run without the model code.
+    """
+    from annotator.recognition.model import Model
+
+    return torch.nn.DataParallel(Model(opt))
+
+
+def _submodule_prefix(model):
+    return "module." if isinstance(model, nn.DataParallel) else ""
+
+
+def quantize_model(model):
+    """
+    Dynamic int8 quantisation of the sequence modelling LSTMs and Linears and of
+    the CTC prediction Linear. The convolutional feature extractor stays fp32.
+    Quantised models run on the CPU only.
+    """
+    prefix = _submodule_prefix(model)
+    qconfig_spec = {
+        f"{prefix}SequenceModeling": default_dynamic_qconfig,
+        f"{prefix}Prediction": default_dynamic_qconfig,
+    }
+    return quantize_dynamic(model.cpu().eval(), qconfig_spec, dtype=torch.qint8)
+
+
+def is_quantized(model):
+    return any(type(module).__module__.startswith("torch.ao.nn.quantized") for module in model.modules())
+
+
+def is_quantized_checkpoint(path):
+    return path.endswith(QUANTIZED_SUFFIX)
+
+
+def load_quantized(path, opt):
+    """
+    Rebuild a model saved by export_quantized. The int8 packed params of its
+    state dict are not plain tensors, so the checkpoint is loaded with
+    weights_only=False (the torch >= 2.6 default is True): only load exports
+    written by this module.
+    """
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if not isinstance(checkpoint, dict) or checkpoint.get("format") != QUANTIZED_FORMAT:
+        raise ValueError(f"Not a {QUANTIZED_FORMAT} checkpoint")
+    model = quantize_model(build_model(opt))
+    model.load_state_dict(checkpoint["state_dict"])
+    return model
+
+
+def export_quantized(opt, output_path=None):
+    """
+    Quantise the checkpoint `opt.saved_model` and save it as `<name>.int8.pth`
+    (or `output_path`). Returns the path written.
+    """
+    model = build_model(opt)
+    model.load_state_dict(torch.load(opt.saved_model, map_location="cpu"))
+    model = quantize_model(model)
+
+    if output_path is None:
+        output_path = os.path.splitext(opt.saved_model)[0] + QUANTIZED_SUFFIX
+    if not is_quantized_checkpoint(output_path):
+        raise ValueError(f"Quantised exports are recognised by their {QUANTIZED_SUFFIX} suffix")
+    tmp_path = f"{output_path}.tmp"
+    torch.save({"format": QUANTIZED_FORMAT, "state_dict": model.state_dict()}, tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+class _Unwrapped(nn.Module):
+    """The model inside DataParallel, so that the trace does not depend on the device count."""
+
+    def __init__(self, model):
+        super(_Unwrapped, self).__init__()
+        self.model = model.module if isinstance(model, nn.DataParallel) else model
+
+    def forward(self, image, text):
+        return self.model(image, text)
+
+
+def export_torchscript(opt, output_path=None):
+    """
+    Trace the checkpoint `opt.saved_model` and save it as `<name>.torchscript.pt`
+    (or `output_path`), with its recognise_lines() options and charset embedded
+    as meta.json. Returns the path written.
+
+    Only CTC models can be traced: the attention decoder's loop depends on the
+    data, and a trace would freeze it.
+    """
+    if "CTC" not in opt.Prediction:
+        raise ValueError("Only CTC recognition models can be exported to TorchScript")
+
+    model = build_model(opt)
+    model.load_state_dict(torch.load(opt.saved_model, map_location="cpu"))
+    model = _Unwrapped(model).eval()
+
+    def example(width):
+        return (
+            torch.zeros(1, opt.input_channel, opt.imgH, width),
+            torch.zeros(1, opt.batch_max_length + 1, dtype=torch.long),
+        )
+
+    with torch.no_grad():
+        # also check a narrower input: batches padded per width bucket are narrower than imgW
+        traced = torch.jit.trace(model, example(opt.imgW), check_inputs=[example(opt.imgW), example(opt.imgW // 2)])
+
+    meta = {
+        "format": TORCHSCRIPT_FORMAT,
+        "source": os.path.basename(opt.saved_model),
+        "options": {
+            "transformation": opt.Transformation,
+            "feature_extraction": opt.FeatureExtraction,
+            "sequence_modeling": opt.SequenceModeling,
+            "prediction": opt.Prediction,
+            "batch_max_length": opt.batch_max_length,
+            "imgH": opt.imgH,
+            "imgW": opt.imgW,
+            "rgb": opt.rgb,
+            "character": opt.character,
+            "sensitive": opt.sensitive,
+            "pad": opt.PAD,
+            "num_fiducial": opt.num_fiducial,
+            "input_channel": opt.input_channel,
+            "output_channel": opt.output_channel,
+            "hidden_size": opt.hidden_size,
+        },
+    }
+
+    if output_path is None:
+        output_path = os.path.splitext(opt.saved_model)[0] + TORCHSCRIPT_SUFFIX
+    tmp_path = f"{output_path}.tmp"
+    torch.jit.save(traced, tmp_path, _extra_files={META_FILE: json.dumps(meta)})
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+EXPORTERS = {QUANTIZED_FORMAT: export_quantized, TORCHSCRIPT_FORMAT: export_torchscript}
+
+
+def main():
+    from annotator.recognition.demo import make_config
+    from annotator.recognition.recognition import RECOGNITION_OPTIONS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint")
+    parser.add_argument("--format", default=QUANTIZED_FORMAT, choices=list(EXPORTERS))
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    opt, _ = make_config(None, args.checkpoint, **RECOGNITION_OPTIONS)
+    print(EXPORTERS[args.format](opt, args.output))
+
+
+if __name__ == "__main__":
+    main()
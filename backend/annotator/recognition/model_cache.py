@@ -0,0 +1,91 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class RecognitionModelCache(object):
+    """
+    LRU cache of loaded recognition models.
+
+    Entries are keyed by (checkpoint path, checkpoint mtime, architecture options),
+    so a checkpoint that is rewritten on disk (e.g. a new `_best_accuracy.pth`
+    written by fine-tuning) gets a new key and the stale model is dropped.
+    The cache holds at most `max_models` models and at most `max_bytes` bytes of
+    parameters and buffers; the least recently used model is evicted first.
+    """
+
+    def __init__(self, max_models=2, max_bytes=2 * 1024 ** 3):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (model, size in bytes)
+
+    def configure(self, max_models=None, max_bytes=None):
+        with self._lock:
+            if max_models is not None:
+                self.max_models = max_models
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, checkpoint_path, options, load_fn):
+        """
+        Return the model for `checkpoint_path`, calling `load_fn()` to build it on a miss.
+
+        options (tuple): hashable architecture options the model was built with.
+        """
+        mtime = os.stat(checkpoint_path).st_mtime_ns
+        key = (os.path.abspath(checkpoint_path), mtime, options)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        # Load outside the lock so a slow load does not block hits on other models.
+        model = load_fn()
+        size = model_size_in_bytes(model)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            # An older version of the same checkpoint can never be hit again.
+            for stale_key in [k for k in self._entries if k[0] == key[0]]:
+                del self._entries[stale_key]
+            self._entries[key] = (model, size)
+            self._evict()
+
+        return model
+
+    def invalidate(self, checkpoint_path=None):
+        """Drop every cached model, or only those loaded from `checkpoint_path`."""
+        with self._lock:
+            if checkpoint_path is None:
+                self._entries.clear()
+            else:
+                path = os.path.abspath(checkpoint_path)
+                for key in [k for k in self._entries if k[0] == path]:
+                    del self._entries[key]
+        torch.cuda.empty_cache()
+
+    def _evict(self):
+        # Always keep the most recently used model, even if it alone exceeds the budget.
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_models
+            or sum(size for _, size in self._entries.values()) > self.max_bytes
+        ):
+            self._entries.popitem(last=False)
+        while self._entries and self.max_models < 1:
+            self._entries.popitem(last=False)
+
+
+def model_size_in_bytes(model):
+    size = sum(p.numel() * p.element_size() for p in model.parameters())
+    size += sum(b.numel() * b.element_size() for b in model.buffers())
+    return size
+
+
+model_cache = RecognitionModelCache()
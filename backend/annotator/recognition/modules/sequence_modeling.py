@@ -13,7 +13,10 @@ class BidirectionalLSTM(nn.Module):
         input : visual feature [batch_size x T x input_size]
         output : contextual feature [batch_size x T x output_size]
         """
-        self.rnn.flatten_parameters()
+        try: # multi gpu needs this
+            self.rnn.flatten_parameters()
+        except AttributeError: # dynamically quantised LSTMs (recognition.export) have no flat weights
+            pass
         recurrent, _ = self.rnn(input)  # batch_size x T x input_size -> batch_size x T x (2*hidden_size)
         output = self.linear(recurrent)  # batch_size x T x output_size
         return output
@@ -1,12 +1,18 @@
 import os
 import subprocess
+import threading
 import torch
 
 from datetime import datetime
 from flask import current_app
+from natsort import natsorted
+from sqlalchemy import func
 
+from annotator.recognition.beam_search import CharNgramLM
 from annotator.recognition.demo import recognise_lines
-from annotator.models import db, RecognitionLog
+from annotator.recognition.torchscript import artifact_options
+from annotator.models import db, RecognitionLog, UserAnnotationLog
+from annotator.page_cache import file_signature, load_cached_page, store_cached_page
 
 def get_filename_without_extension(file_path):
     """
@@ -24,49 +30,177 @@ def get_filename_without_extension(file_path):
 def get_subfolders(folder_path):
     return [subfolder for subfolder in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, subfolder))]
 
-def recognise_characters(folder_path, model, manuscript_name):
-    lines_of_all_pages = {}
+
+# Architecture and data options of the recognition models in models/recognition
+RECOGNITION_OPTIONS = dict(
+    transformation=None,
+    feature_extraction="ResNet",
+    sequence_modeling="BiLSTM",
+    prediction="CTC",
+    workers=0,
+    batch_max_length=250,
+    imgH=50,
+    imgW=2000,
+    pad=True,
+    character="""`0123456789~!@#$%^&*()-_+=[]\\{}|;':",./<>? abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ.ँंःअअंअःआइईउऊऋएऐऑओऔकखगघङचछजझञटठडढणतथदधनऩपफबभमयरऱलळवशषसह़ािीुूृॅेैॉोौ्ॐ॒क़ख़ग़ज़ड़ढ़फ़ॠ।०१२३४५६७८९॰""",
+    hidden_size=512,
+    output_channel=512,
+)
+
+
+_annotation_lm_lock = threading.Lock()
+_annotation_lm = {"key": None, "lm": None}
+
+
+def annotation_language_model(character, order):
+    """
+    Character n-gram model of the corrected lines (UserAnnotationLog.ground_truth)
+    over `character`. It is rebuilt only when annotations were added since the last call.
+
+    Returns (lm, key), `key` being (order, count, last id) of the annotations it was
+    built from, which identifies the model for a given charset.
+    """
+    count, last_id = db.session.query(func.count(UserAnnotationLog.id), func.max(UserAnnotationLog.id)).one()
+    key = (character, order, count, last_id)
+    with _annotation_lm_lock:
+        if _annotation_lm["key"] != key:
+            texts = [ground_truth for (ground_truth,) in db.session.query(UserAnnotationLog.ground_truth)]
+            _annotation_lm["lm"] = CharNgramLM(character, texts, order=order)
+            _annotation_lm["key"] = key
+        return _annotation_lm["lm"], key[1:]
+
+
+def decode_options(decode, character):
+    """
+    recognise_lines() decoding options for `decode` (default: RECOGNITION_DECODE), from the app config.
+    Returns (options, lm_key), `lm_key` identifying the language model in use, None without one.
+    """
+    config = current_app.config
+    decode = decode or config['RECOGNITION_DECODE']
+    if decode != "beamsearch":
+        return {"decode": decode}, None
+    use_lm = config['BEAM_LM_ORDER'] > 0 and config['BEAM_LM_WEIGHT'] > 0
+    lm, lm_key = annotation_language_model(character, config['BEAM_LM_ORDER']) if use_lm else (None, None)
+    return {
+        "decode": decode,
+        "beam_width": config['BEAM_WIDTH'],
+        "beam_top_k": config['BEAM_TOP_K'],
+        "lm": lm,
+        "lm_weight": config['BEAM_LM_WEIGHT'],
+    }, lm_key
+
+
+# Per-model cache of the recognised lines of each page, in <manuscript>/recognition-cache/<model>/<page>.json
+RECOGNITION_CACHE_DIR = "recognition-cache"
+LINE_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def recognise_characters(folder_path, model, manuscript_name, pages=None, decode=None):
+    """
+    Recognise every line image of a manuscript (or of `pages` only) in a single pass.
+    `decode` is "greedy" or "beamsearch", RECOGNITION_DECODE by default.
+
+    Lines of all pages go through one DataLoader, so batches are filled across
+    page boundaries instead of running one small, partially filled batch per
+    page. The results are then split back per page: {page: [lines]}.
+
+    Results are cached per page and model, and a line is only recognised again
+    if its image changed (RECOGNITION_RESULT_CACHE), which also covers the lines
+    rewritten by manual re-segmentation, and a page is decoded again whenever the
+    beam search language model changed. Every returned line is added to RecognitionLog.
+    """
     lines_folder_path = os.path.join(folder_path, "lines")
-    page_subfolders = get_subfolders(lines_folder_path)
+    page_subfolders = get_subfolders(lines_folder_path) if pages is None else list(pages)
+
+    # TorchScript artifacts carry their own architecture options and charset
+    saved_model = os.path.join(current_app.config['DATA_PATH'], 'models', 'recognition', model)
+    options = artifact_options(saved_model, RECOGNITION_OPTIONS)
+    decoding, lm_key = decode_options(decode, options["character"])
+
+    use_cache = current_app.config['RECOGNITION_RESULT_CACHE']
+    cache_dir = os.path.join(folder_path, RECOGNITION_CACHE_DIR, model)
+    cache_key = {
+        "model": file_signature(saved_model),
+        "decode": {name: value for name, value in decoding.items() if name != "lm"},
+        # a list, as read back from JSON: annotations added since re-decode the page
+        "lm": None if lm_key is None else list(lm_key),
+    }
+
+    # {page: {line: result}}, the result being None for lines to recognise
+    results_of_all_pages = {}
+    pending = []
+    changed_pages = set()
     for page_subfolder in page_subfolders:
-        lines_of_one_page = recognise_lines(
-            image_folder=os.path.join(lines_folder_path, page_subfolder),
-            saved_model=os.path.join(current_app.config['DATA_PATH'], 'models', 'recognition', model),
-            transformation=None,
-            feature_extraction="ResNet",
-            sequence_modeling="BiLSTM",
-            prediction="CTC",
-            workers=0,
-            batch_max_length=250,
-            imgH=50,
-            imgW=2000,
-            pad=True,
-            character="""`0123456789~!@#$%^&*()-_+=[]\\{}|;':",./<>? abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ.ँंःअअंअःआइईउऊऋएऐऑओऔकखगघङचछजझञटठडढणतथदधनऩपफबभमयरऱलळवशषसह़ािीुूृॅेैॉोौ्ॐ॒क़ख़ग़ज़ड़ढ़फ़ॠ।०१२३४५६७८९॰""",
-            hidden_size=512,
-            output_channel=512,
+        page_folder = os.path.join(lines_folder_path, page_subfolder)
+        cached = (load_cached_page(cache_dir, page_subfolder, cache_key) or {}) if use_cache else {}
+        results = results_of_all_pages[page_subfolder] = {}
+        file_names = os.listdir(page_folder) if os.path.isdir(page_folder) else []
+        for file_name in natsorted(file_names):
+            if not file_name.lower().endswith(LINE_IMAGE_EXTENSIONS):
+                continue
+            image_path = os.path.join(page_folder, file_name)
+            line_name = get_filename_without_extension(file_name)
+            signature = file_signature(image_path)
+            hit = cached.get(line_name)
+            if hit is not None and hit["signature"] == signature:
+                results[line_name] = {**hit, "image_path": image_path}
+            else:
+                results[line_name] = None
+                pending.append((page_subfolder, line_name, image_path, signature))
+                changed_pages.add(page_subfolder)
+        if set(cached) - set(results):
+            changed_pages.add(page_subfolder)
+
+    if pending:
+        recognised = recognise_lines(
+            image_folder=[image_path for _, _, image_path, _ in pending],
+            saved_model=saved_model,
+            **options,
+            **decoding,
         )
-        for line in lines_of_one_page:
-            line["manuscript_name"] = manuscript_name
-            line["selected_model"] = model
-            line["page"] = page_subfolder
-            line["line"] = get_filename_without_extension(line["image_path"])
+        recognised = {line["image_path"]: line for line in recognised}
+        for page_subfolder, line_name, image_path, signature in pending:
+            line = recognised[image_path]
+            results_of_all_pages[page_subfolder][line_name] = {
+                "signature": signature,
+                "image_path": image_path,
+                "predicted_label": line["predicted_label"],
+                "confidence_score": line["confidence_score"],
+            }
 
+        # clear GPU memory
+        del recognised
+        torch.cuda.empty_cache()
+
+    # every returned line is logged, whether it came from the cache or the model
+    lines_of_all_pages = {}
+    for page_subfolder, results in results_of_all_pages.items():
+        for line_name, result in results.items():
             # Add model name to Log
             log_entry = RecognitionLog(
-                image_path=line["image_path"],
-                predicted_label=line["predicted_label"],
-                confidence_score=line["confidence_score"],
+                image_path=result["image_path"],
+                predicted_label=result["predicted_label"],
+                confidence_score=result["confidence_score"],
                 manuscript_name=manuscript_name,
                 page=page_subfolder,
-                line=line["line"],
+                line=line_name,
                 timestamp=datetime.now()
             )
             db.session.add(log_entry)
-        db.session.commit()
-        lines_of_all_pages[page_subfolder] = lines_of_one_page
-    
-    # clear GPU memory
-    del lines_of_one_page
-    torch.cuda.empty_cache()
-    
-    return lines_of_all_pages
\ No newline at end of file
+        lines_of_all_pages[page_subfolder] = [
+            {
+                "image_path": result["image_path"],
+                "predicted_label": result["predicted_label"],
+                "confidence_score": result["confidence_score"],
+                "manuscript_name": manuscript_name,
+                "selected_model": model,
+                "page": page_subfolder,
+                "line": line_name,
+            }
+            for line_name, result in results.items()
+        ]
+        if use_cache and page_subfolder in changed_pages:
+            store_cached_page(cache_dir, page_subfolder, cache_key, results)
+    db.session.commit()
+
+    return lines_of_all_pages
@@ -0,0 +1,40 @@
+"""
+Self-describing TorchScript recognition artifacts (<name>.torchscript.pt,
+written by recognition.export). The architecture options and the charset
+are embedded in the archive as meta.json, so an artifact can be loaded and
+run without the Python model definitions in recognition/modules.
+"""
+import json
+import zipfile
+
+import torch
+
+
+TORCHSCRIPT_FORMAT = "torchscript"
+TORCHSCRIPT_SUFFIX = ".torchscript.pt"
+META_FILE = "meta.json"
+
+
+def is_torchscript(path):
+    return path.endswith(TORCHSCRIPT_SUFFIX)
+
+
+def read_meta(path):
+    """meta.json of an artifact, read from the archive without loading the model."""
+    with zipfile.ZipFile(path) as archive:
+        name = next(name for name in archive.namelist() if name.endswith(f"/extra/{META_FILE}"))
+        return json.loads(archive.read(name).decode("utf-8"))
+
+
+def artifact_options(path, defaults):
+    """recognise_lines() options for `path`: `defaults`, overridden by the artifact's own options."""
+    if not is_torchscript(path):
+        return dict(defaults)
+    return {**defaults, **read_meta(path)["options"]}
+
+
+def load_torchscript(path, device):
+    """Return (module, meta). The module is called like the Python model: module(image, text)."""
+    extra_files = {META_FILE: ""}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    return module, json.loads(extra_files[META_FILE])
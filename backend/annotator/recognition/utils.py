@@ -1,7 +1,39 @@
 import torch
+from annotator.recognition.beam_search import ctc_beam_search
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
+def ctc_greedy_collapse(text_index, length, ignore_idx=(0,)):
+    """ greedy CTC decoding of argmax indices: drop repeats of the previous step, then blanks.
+    input:
+        text_index: argmax indices [batch_size, T], or their concatenation [sum(length)] (baidu warpctc).
+        length: number of valid steps of each row. [batch_size]
+        ignore_idx: indices dropped after the repeat check, 0 ('CTCblank') by default.
+
+    output:
+        list of the kept indices of each row, as python ints.
+    """
+    length = torch.as_tensor(length).long().cpu()
+    text_index = text_index.cpu()
+    if text_index.dim() == 1:
+        rows = torch.split(text_index, length.tolist())
+        text_index = torch.nn.utils.rnn.pad_sequence(rows, batch_first=True)
+
+    previous = torch.cat([torch.full_like(text_index[:, :1], -1), text_index[:, :-1]], dim=1)
+    keep = text_index != previous
+    for idx in ignore_idx:
+        keep &= text_index != idx
+    keep &= torch.arange(text_index.size(1)).unsqueeze(0) < length.unsqueeze(1)
+
+    kept = text_index[keep].tolist()
+    counts = keep.sum(dim=1).tolist()
+    result, start = [], 0
+    for count in counts:
+        result.append(kept[start:start + count])
+        start += count
+    return result
+
+
 class CTCLabelConverter(object):
     """ Convert between text-label and text-index """
 
@@ -15,6 +47,8 @@ class CTCLabelConverter(object):
             self.dict[char] = i + 1
 
         self.character = ['[CTCblank]'] + dict_character  # dummy '[CTCblank]' token for CTCLoss (index 0)
+        # spaces are dropped from the predictions, like blanks
+        self.ignore_idx = [0] + [i for i, char in enumerate(self.character) if char == ' ']
 
     def encode(self, text, batch_max_length=25):
         """convert text-label into text-index.
@@ -38,15 +72,15 @@ class CTCLabelConverter(object):
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """
+        return [''.join([self.character[i] for i in t]) for t in ctc_greedy_collapse(text_index, length, self.ignore_idx)]
+
+    def decode_beamsearch(self, mat, **kwargs):
+        """ convert log-probabilities [batch_size, T, num_class] into text-labels with
+        recognition.beam_search.ctc_beam_search (kwargs: beam_width, top_k, lm, lm_weight). """
         texts = []
-        for index, l in enumerate(length):
-            t = text_index[index, :]
-            char_list = []
-            for i in range(l):
-                if t[i]!=0 and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank.
-                  char_list.append(self.character[t[i]])
-            text = ''.join(list(filter((" ").__ne__, char_list)))
-            texts.append(text)
+        for log_probs in mat.float().cpu().numpy():
+            t = ctc_beam_search(log_probs, **kwargs)
+            texts.append(''.join([self.character[i] for i in t if i not in self.ignore_idx]))
         return texts
 
 
@@ -81,20 +115,7 @@ class CTCLabelConverterForBaiduWarpctc(object):
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """
-        texts = []
-        index = 0
-        for l in length:
-            t = text_index[index:index + l]
-
-            char_list = []
-            for i in range(l):
-                if t[i] != 0 and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank.
-                    char_list.append(self.character[t[i]])
-            text = ''.join(char_list)
-
-            texts.append(text)
-            index += l
-        return texts
+        return [''.join([self.character[i] for i in t]) for t in ctc_greedy_collapse(text_index, length)]
 
 
 class AttnLabelConverter(object):
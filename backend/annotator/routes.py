@@ -1,15 +1,21 @@
 import os
-import threading
 
-from flask import Blueprint, request, send_from_directory, current_app
+from flask import Blueprint, request, send_from_directory, current_app, url_for
 from PIL import Image
 import torch
 import gc
 
-from annotator.segmentation import segment_lines
-from annotator.manual_segmentation import run_manual_segmentation
-from annotator.recognition.recognition import recognise_characters
+from annotator.segmentation import segment_lines, unload_detector
+from annotator.manual_segmentation import render_page_overlay, run_manual_segmentation
+from annotator.recognition.recognition import RECOGNITION_OPTIONS, recognise_characters, get_subfolders
+from annotator.recognition.demo import make_config
+from annotator.recognition.export import EXPORTERS, QUANTIZED_FORMAT, QUANTIZED_SUFFIX
+from annotator.recognition.torchscript import TORCHSCRIPT_SUFFIX
 from annotator.finetune.finetune import finetune
+from annotator.jobs import JobQueueFull, job_manager, training_manager
+from annotator.page_cache import (
+    PREVIEW_SCALES, file_hash, file_signature, leaf_preview, load_cached_page, store_cached_page,
+)
 
 
 #importing GNN libraries
@@ -50,7 +56,38 @@ def hello():
 
 @bp.route("/models")
 def get_models():
-    return os.listdir(os.path.join(current_app.config['DATA_PATH'], 'models', 'recognition'))
+    """Recognition checkpoints, including exported variants such as <name>.int8.pth"""
+    return sorted(os.listdir(os.path.join(current_app.config['DATA_PATH'], 'models', 'recognition')))
+
+
+@bp.route("/models/<string:model>/export", methods=["POST"])
+def export_model(model):
+    """
+    Write a deployment variant of a recognition checkpoint next to it.
+    JSON body: {"format": "dynamic-int8" | "torchscript"}
+    """
+    models_path = os.path.join(current_app.config['DATA_PATH'], 'models', 'recognition')
+    if model not in os.listdir(models_path):
+        return {"error": "Model not found"}, 404
+    if model.endswith((QUANTIZED_SUFFIX, TORCHSCRIPT_SUFFIX)):
+        return {"error": "Exports can only be made from a trained checkpoint"}, 400
+    export_format = (request.get_json(silent=True) or {}).get("format", QUANTIZED_FORMAT)
+    if export_format not in EXPORTERS:
+        return {"error": f"Unsupported export format {export_format!r}"}, 400
+
+    opt, _ = make_config(None, os.path.join(models_path, model), **RECOGNITION_OPTIONS)
+    try:
+        output_path = EXPORTERS[export_format](opt)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return {"model": os.path.basename(output_path), "format": export_format}, 201
+
+
+@bp.route("/models/segmentation/unload", methods=["POST"])
+def unload_segmentation_model():
+    unloaded = unload_detector()
+    gc.collect()
+    return {"unloaded": unloaded}, 200
 
 
 @bp.route("/line-images/<string:manuscript_name>/<string:page>/<string:line>")
@@ -61,13 +98,57 @@ def serve_line_image(manuscript_name, page, line):
     )
 
 
-@bp.route("/upload-manuscript", methods=["POST"])
-def annotate():
+def find_leaf_image(manuscript_path, page):
+    """Path of the .jpg or .tif leaf image of `page`."""
+    filepath_jpg = os.path.join(manuscript_path, "leaves", f"{page}.jpg")
+    filepath_tif = os.path.join(manuscript_path, "leaves", f"{page}.tif")
+    if os.path.exists(filepath_jpg):
+        return filepath_jpg
+    elif os.path.exists(filepath_tif):
+        return filepath_tif
+    raise FileNotFoundError("Neither .jpg nor .tif image file found for the given page.")
+
+
+@bp.route("/leaf-preview/<string:manuscript_name>/<string:page>")
+def serve_leaf_preview(manuscript_name, page):
+    """
+    Serve a downscaled JPEG of a leaf (?scale=0.25|0.5|1.0, default 0.5).
+
+    Previews are cached on disk in <manuscript>/previews and sent with ETag and
+    Last-Modified, so browsers revalidate instead of downloading them again.
+    URLs carrying the leaf's version (?v=...) are cacheable for a year.
+    """
     MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
-    uploaded_files = request.files
-    manuscript_name = request.form["manuscript_name"]
-    model = request.form["model"]
-    folder_path = os.path.join(MANUSCRIPTS_PATH, manuscript_name)
+    scale = request.args.get("scale", default=0.5, type=float)
+    if scale not in PREVIEW_SCALES:
+        return {"error": f"scale must be one of {PREVIEW_SCALES}"}, 400
+    try:
+        leaf_path = find_leaf_image(os.path.join(MANUSCRIPTS_PATH, manuscript_name), page)
+    except FileNotFoundError as e:
+        return {"error": str(e)}, 404
+
+    preview_path = leaf_preview(
+        leaf_path, os.path.join(MANUSCRIPTS_PATH, manuscript_name, "previews"), page, scale
+    )
+    max_age = 365 * 24 * 3600 if "v" in request.args else 0
+    return send_from_directory(
+        os.path.dirname(preview_path), os.path.basename(preview_path), max_age=max_age
+    )
+
+
+def segmentation_options():
+    """segment_lines() keyword arguments from the app config"""
+    return dict(
+        model_path=current_app.config['CRAFT_MODEL_PATH'],
+        detect_batch_size=current_app.config['DETECTION_BATCH_SIZE'],
+        tile_size=current_app.config['DETECTION_TILE_SIZE'] or None,
+        tile_overlap=current_app.config['DETECTION_TILE_OVERLAP'],
+        max_detector_memory_mb=current_app.config['DETECTION_MAX_MEMORY_MB'] or None,
+        detection_scale=current_app.config['DETECTION_SCALE'],
+    )
+
+
+def save_uploaded_leaves(folder_path):
     leaves_folder_path = os.path.join(folder_path, "leaves")
 
     try:
@@ -79,7 +160,17 @@ def annotate():
         filename = request.files[file].filename
         request.files[file].save(os.path.join(leaves_folder_path, filename))
 
-    segment_lines(os.path.join(folder_path, "leaves"))
+
+@bp.route("/upload-manuscript", methods=["POST"])
+def annotate():
+    MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
+    manuscript_name = request.form["manuscript_name"]
+    model = request.form["model"]
+    folder_path = os.path.join(MANUSCRIPTS_PATH, manuscript_name)
+    save_uploaded_leaves(folder_path)
+
+    timings = segment_lines(os.path.join(folder_path, "leaves"), **segmentation_options())
+    print(f"segmentation of {manuscript_name}: " + ", ".join(f"{stage}: {seconds:.2f}s" for stage, seconds in timings.items()))
     lines = recognise_characters(folder_path, model, manuscript_name)
     torch.cuda.empty_cache()
     gc.collect()
@@ -88,20 +179,108 @@ def annotate():
     return lines, 200
 
 
-def finetune_context(data, app_context):
-    # app_context.push()
-    with app_context:
-        finetune(data)
+def process_manuscript(job, manuscript_name, model):
+    """
+    Job version of /upload-manuscript: segment the leaves, then recognise the
+    lines a few pages at a time so that pollers see the results of each page
+    as soon as its chunk is done.
+    """
+    MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
+    folder_path = os.path.join(MANUSCRIPTS_PATH, manuscript_name)
 
+    timings = segment_lines(os.path.join(folder_path, "leaves"), progress_callback=job.set_progress, **segmentation_options())
+    job.set_timings("segmentation", timings)
 
-@bp.route("/fine-tune", methods=["POST"])
-def do_finetune():
+    pages = sorted(get_subfolders(os.path.join(folder_path, "lines")))
+    chunk_size = max(1, current_app.config['JOB_RECOGNITION_CHUNK_PAGES'])
+    job.set_progress("recognition", 0, len(pages))
+    try:
+        for start in range(0, len(pages), chunk_size):
+            lines = recognise_characters(folder_path, model, manuscript_name, pages=pages[start:start + chunk_size])
+            job.add_results(lines)
+            job.set_progress("recognition", min(start + chunk_size, len(pages)), len(pages))
+    finally:
+        torch.cuda.empty_cache()
+        gc.collect()
+
+
+@bp.route("/jobs/upload-manuscript", methods=["POST"])
+def submit_upload_manuscript():
+    """
+    Same form as /upload-manuscript, but only stores the leaves and returns a
+    job id right away (202). Poll /jobs/<job_id> for per-stage progress, the
+    segmentation timings and the recognised lines of finished pages.
+    """
     MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
-    thread = threading.Thread(
-        target=finetune_context, args=(request.json, current_app.app_context())
+    manuscript_name = request.form["manuscript_name"]
+    model = request.form["model"]
+    save_uploaded_leaves(os.path.join(MANUSCRIPTS_PATH, manuscript_name))
+
+    job = job_manager.submit(
+        "upload-manuscript",
+        process_manuscript,
+        {"manuscript_name": manuscript_name, "model": model},
+        current_app._get_current_object(),
     )
-    thread.start()
-    return "Success", 200
+    return {"job_id": job.id, "status": job.status}, 202
+
+
+def find_job_manager(job_id):
+    for manager in (job_manager, training_manager):
+        if manager.get(job_id) is not None:
+            return manager
+    return None
+
+
+@bp.route("/jobs", methods=["GET"])
+def list_jobs():
+    """Upload and fine-tuning jobs, optionally filtered with ?kind=upload-manuscript|fine-tune."""
+    kind = request.args.get("kind")
+    jobs = job_manager.list() + training_manager.list()
+    return [job.to_dict(include_results=False) for job in jobs if kind is None or job.kind == kind], 200
+
+
+@bp.route("/jobs/<string:job_id>", methods=["GET"])
+def get_job(job_id):
+    """Job status; ?results=false leaves out the (partial) results."""
+    manager = find_job_manager(job_id)
+    if manager is None:
+        return {"error": "Job not found"}, 404
+    include_results = request.args.get("results", default="true").lower() != "false"
+    return manager.get(job_id).to_dict(include_results=include_results), 200
+
+
+@bp.route("/jobs/<string:job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    manager = find_job_manager(job_id)
+    if manager is None:
+        return {"error": "Job not found"}, 404
+    return manager.cancel(job_id).to_dict(include_results=False), 200
+
+
+def finetune_job(job, data):
+    finetune(data, progress_callback=lambda done, total: job.set_progress("training", done, total))
+
+
+@bp.route("/fine-tune", methods=["POST"])
+def do_finetune():
+    """
+    Queue a fine-tuning run (202 with its job id, or 429 if the queue is full).
+    Runs are trained one at a time; poll /jobs/<job_id> for progress and ETA.
+    """
+    data = request.json
+    info = {
+        "manuscript_name": data[0]["manuscript_name"],
+        "selected_model": data[0]["selected_model"],
+        "model_name": data[0].get("model_name", f"{data[0]['manuscript_name']}.pth"),
+    }
+    try:
+        job = training_manager.submit(
+            "fine-tune", finetune_job, {"data": data}, current_app._get_current_object(), info=info
+        )
+    except JobQueueFull as e:
+        return {"error": str(e)}, 429
+    return {"job_id": job.id, "status": job.status}, 202
 
 
 @bp.route("/uploaded-manuscripts", methods=["GET"])
@@ -117,9 +296,13 @@ def recognise_manuscript():
     model = request.json.get("model")
     print(manuscript_name)
     print(model)
+    decode = request.json.get("decode")  # "greedy" or "beamsearch", default RECOGNITION_DECODE
     folder_path = os.path.join(MANUSCRIPTS_PATH, manuscript_name)
     print(folder_path)
-    lines = recognise_characters(folder_path, model, manuscript_name)
+    try:
+        lines = recognise_characters(folder_path, model, manuscript_name, decode=decode)
+    except ValueError as e:
+        return {"error": str(e)}, 400
     print(lines)
     return lines, 200
 
@@ -131,8 +314,8 @@ def get_points(manuscript_name, page):
         IMAGE_FILEPATH = os.path.join(
             MANUSCRIPTS_PATH, manuscript_name, "leaves", f"{page}.jpg"
         )
-        image = Image.open(IMAGE_FILEPATH)
-        width, height = image.size
+        with Image.open(IMAGE_FILEPATH) as image:
+            width, height = image.size
         response = {"dimensions": [width, height]}
         POINTS_FILEPATH = os.path.join(
             MANUSCRIPTS_PATH, manuscript_name, "points-2D", f"{page}_points.txt"
@@ -148,8 +331,51 @@ def get_points(manuscript_name, page):
         return {"error": str(e)}, 500
 
 
+def add_recognised_lines(response, manuscript_name, page):
+    """
+    Add the recognised lines of a page just re-segmented to `response` if the
+    request names a model (?model=<name>[&decode=greedy|beamsearch]). Only the
+    regenerated lines go through the model, the others come from the recognition
+    cache. The segmentation is already saved at this point, so a failure of the
+    recognition is reported as `recognition_error` instead of failing the request.
+    """
+    model = request.args.get("model")
+    if not model:
+        return response
+    MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
+    try:
+        lines = recognise_characters(
+            os.path.join(MANUSCRIPTS_PATH, manuscript_name), model, manuscript_name,
+            pages=[page], decode=request.args.get("decode"),
+        )
+    except Exception as e:
+        response["recognition_error"] = str(e)
+    else:
+        response["lines"] = lines[page]
+    return response
+
+
+def check_recognition_args():
+    """Error response for an unknown ?model= or ?decode= of add_recognised_lines(), else None."""
+    model = request.args.get("model")
+    models_path = os.path.join(current_app.config['DATA_PATH'], 'models', 'recognition')
+    if model and model not in os.listdir(models_path):
+        return {"error": "Model not found"}, 404
+    if request.args.get("decode") not in (None, "greedy", "beamsearch"):
+        return {"error": "decode must be greedy or beamsearch"}, 400
+    return None
+
+
 @bp.route("/segment/<string:manuscript_name>/<string:page>", methods=["POST"])
 def make_segments(manuscript_name, page):
+    """
+    Save the line labels of the page's points and regenerate its line images.
+    With ?model=<name>, the response also carries the recognised lines of the
+    page, or the recognition_error if recognising them failed.
+    """
+    error = check_recognition_args()
+    if error is not None:
+        return error
     MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
     segments = request.get_json()
     labels_file = os.path.join(
@@ -161,7 +387,18 @@ def make_segments(manuscript_name, page):
 
     run_manual_segmentation(manuscript_name, page)
 
-    return {"message": f"succesfully saved labels for page {page}"}, 200
+    response = {"message": f"succesfully saved labels for page {page}"}
+    return add_recognised_lines(response, manuscript_name, page), 200
+
+
+@bp.route("/segment/<string:manuscript_name>/<string:page>/overlay", methods=["GET"])
+def get_segmentation_overlay(manuscript_name, page):
+    """Debug overlay of the page's labelled boxes and points, re-rendered only after the labels change."""
+    try:
+        overlay_path = render_page_overlay(manuscript_name, page)
+    except FileNotFoundError as e:
+        return {"error": str(e)}, 404
+    return send_from_directory(os.path.dirname(overlay_path), os.path.basename(overlay_path), max_age=0)
 
 
 
@@ -194,6 +431,14 @@ def make_segments(manuscript_name, page):
 
 @bp.route("/semi-segment/<string:manuscript_name>/<string:page>", methods=["POST"])
 def make_semi_segments(manuscript_name, page):
+    """
+    Save the edited graph of the page, derive its line labels and regenerate its
+    line images. With ?model=<name>, the response also carries the recognised
+    lines of the page, or the recognition_error if recognising them failed.
+    """
+    error = check_recognition_args()
+    if error is not None:
+        return error
     try:
         MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
         POINTS_FILEPATH = os.path.join(
@@ -236,8 +481,9 @@ def make_semi_segments(manuscript_name, page):
 
         # Run manual segmentation after saving labels
         run_manual_segmentation(manuscript_name, page)
-        
-        return {"message": f"Graph and segmentation data saved for {manuscript_name} page {page}"}, 200
+
+        response = {"message": f"Graph and segmentation data saved for {manuscript_name} page {page}"}
+        return add_recognised_lines(response, manuscript_name, page), 200
 
     except Exception as e:
         return {"error": str(e)}, 500
@@ -299,56 +545,41 @@ def get_points_and_graph(manuscript_name, page):
     MANUSCRIPTS_PATH = os.path.join(current_app.config['DATA_PATH'], 'manuscripts')
     try:
         print("Getting points and generating graph")
-        # IMAGE_FILEPATH = os.path.join(
-        #     MANUSCRIPTS_PATH, manuscript_name, "leaves", f"{page}.jpg"
-        # )
-        # image = plt.imread(IMAGE_FILEPATH)  # Replace with your image path
-        # image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2))
-        # Build potential file paths for jpg and tif files
-        filepath_jpg = os.path.join(MANUSCRIPTS_PATH, manuscript_name, "leaves", f"{page}.jpg")
-        filepath_tif = os.path.join(MANUSCRIPTS_PATH, manuscript_name, "leaves", f"{page}.tif")
-
-        # Check which file exists
-        if os.path.exists(filepath_jpg):
-            IMAGE_FILEPATH = filepath_jpg
-        elif os.path.exists(filepath_tif):
-            IMAGE_FILEPATH = filepath_tif
-        else:
-            raise FileNotFoundError("Neither .jpg nor .tif image file found for the given page.")
-
-        # Read the image using the appropriate method based on the file extension
-        if IMAGE_FILEPATH.lower().endswith('.tif'):
-            # Use Pillow to open TIFF images and convert to a NumPy array
-            image = np.array(Image.open(IMAGE_FILEPATH))
-        else:
-            image = plt.imread(IMAGE_FILEPATH)
-        
-        image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2))
-        # Store original dimensions
-        height, width = image.shape[:2]
-        _image = Image.fromarray((image * 255).astype(np.uint8)) if image.dtype == np.float32 else Image.fromarray(image)
-        # Convert to RGB if not already
-        if _image.mode != "RGB":
-            _image = _image.convert("RGB")
-        # Send original dimensions in response
-        response = {"dimensions": [width, height]}
-        
-        # Convert image to base64 for sending in response
-        buffered = io.BytesIO()
-        _image.save(buffered, format="JPEG", quality=85)  # Reduced quality for better performance
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        response["image"] = img_str
-        
-        
+        IMAGE_FILEPATH = find_leaf_image(os.path.join(MANUSCRIPTS_PATH, manuscript_name), page)
+
         POINTS_FILEPATH = os.path.join(
             MANUSCRIPTS_PATH, manuscript_name, "points-2D", f"{page}_points.txt"
         )
         GRAPH_FILEPATH = os.path.join(
             MANUSCRIPTS_PATH, manuscript_name, "points-2D"
         )
+        CACHE_DIR = os.path.join(MANUSCRIPTS_PATH, manuscript_name, "graph-cache")
 
         if not os.path.exists(POINTS_FILEPATH):
             return {"error": "Page not found"}, 404
+
+        # The leaf itself is served separately as a cached half-resolution preview
+        image_signature = file_signature(IMAGE_FILEPATH)
+        image_url = url_for(
+            "main.serve_leaf_preview", manuscript_name=manuscript_name, page=page, scale=0.5, v=image_signature
+        )
+
+        # Reuse the graph computed for the same points file and leaf image
+        cache_key = {"points": file_hash(POINTS_FILEPATH), "image": image_signature}
+        response = load_cached_page(CACHE_DIR, page, cache_key)
+        # the cached response is only complete if the GNN export of the generated graph (.pt and .json) exists
+        gnn_graph_exists = all(
+            os.path.exists(os.path.join(GRAPH_FILEPATH, f"{manuscript_name}_page{page}_graph.{ext}"))
+            for ext in ("pt", "json")
+        )
+        if response is not None and gnn_graph_exists:
+            response["image_url"] = image_url
+            return response, 200
+
+        # Dimensions of the half-resolution preview, read from the image header only
+        with Image.open(IMAGE_FILEPATH) as image:
+            width, height = image.size
+        response = {"dimensions": [width // 2, height // 2]}
             
         # Load points from file
         with open(POINTS_FILEPATH, "r") as f:
@@ -363,104 +594,115 @@ def get_points_and_graph(manuscript_name, page):
 
         response["points"] = points
         response["graph"] = graph_data
-        
+
+        store_cached_page(CACHE_DIR, page, cache_key, response)
+
+        response["image_url"] = image_url
         return response, 200
     except Exception as e:
         print(f"Error: {str(e)}")
         return {"error": str(e)}, 500
 
-def generate_layout_graph(points):
+
+def compute_layout_edges(points):
     """
-    Generate a graph representation of text layout based on points.
-    This function implements the core layout analysis logic from the notebook.
+    Connect every point to the pair of its nearest neighbours that lie in (nearly)
+    opposite directions and are closest together.
+
+    All points and all neighbour pairs are processed at once on an (N, k, 2)
+    neighbour tensor.
+
+    Returns:
+        edges: (2 * M, 2) array, two edges per connected point.
+        edge_properties: (M, 5) array of features of each edge pair, used for clustering.
     """
     NUM_NEIGHBOURS = 8
     cos_similarity_less_than = -0.8
-    
+
+    points = np.asarray(points, dtype=float)
+
     # Build a KD-tree for fast neighbor lookup
     tree = cKDTree(points)
     _, indices = tree.query(points, k=NUM_NEIGHBOURS)
-    
-    # Store graph edges and their properties
-    edges = []
-    edge_properties = []
-    
-    # Process nearest neighbors
-    for current_point_index, nbr_indices in enumerate(indices):
-        normalized_points = np.array(points)[nbr_indices] - np.array(points)[current_point_index]
-        scaling_factor = np.max(np.abs(normalized_points))
-        if scaling_factor == 0:
-            scaling_factor = 1
-        scaled_points = normalized_points / scaling_factor
-        
-        # Create a list of relative neighbors with their global indices
-        relative_neighbours = [
-            (global_idx, sp, np) 
-            for global_idx, sp, np in zip(nbr_indices, scaled_points, normalized_points)
-        ]
-        
-        filtered_neighbours = []
-        for i, neighbor1 in enumerate(relative_neighbours):
-            for neighbor2 in relative_neighbours[i+1:]:
-                if np.linalg.norm(neighbor1[1]) * np.linalg.norm(neighbor2[1]) == 0:
-                    cos_similarity = 0.0
-                else:
-                    cos_similarity = np.dot(neighbor1[1], neighbor2[1]) / (
-                        np.linalg.norm(neighbor1[1]) * np.linalg.norm(neighbor2[1])
-                    )
-                
-                # Calculate non-normalized distances
-                norm1 = np.linalg.norm(neighbor1[2])
-                norm2 = np.linalg.norm(neighbor2[2])
-                total_length = norm1 + norm2
-                
-                # Select pairs with angles close to 180 degrees (opposite directions)
-                if cos_similarity < cos_similarity_less_than:
-                    filtered_neighbours.append((neighbor1, neighbor2, total_length, cos_similarity))
-        
-        if filtered_neighbours:
-            # Find the shortest total length pair
-            shortest_pair = min(filtered_neighbours, key=lambda x: x[2])
-            
-            connection_1, connection_2, total_length, cos_similarity = shortest_pair
-            global_idx_connection_1 = connection_1[0]
-            global_idx_connection_2 = connection_2[0]
-            
-            # Calculate angles with x-axis
-            theta_a = np.degrees(np.arctan2(connection_1[2][1], connection_1[2][0]))
-            theta_b = np.degrees(np.arctan2(connection_2[2][1], connection_2[2][0]))
-            
-            # Add edges to the graph
-            edges.append([current_point_index, global_idx_connection_1])
-            edges.append([current_point_index, global_idx_connection_2])
-            
-            # Calculate feature values for clustering
-            y_diff1 = abs(connection_1[2][1])  # Vertical distance component
-            y_diff2 = abs(connection_2[2][1])
-            avg_y_diff = (y_diff1 + y_diff2) / 2
-            
-            x_diff1 = abs(connection_1[2][0])  # Horizontal distance component
-            x_diff2 = abs(connection_2[2][0])
-            avg_x_diff = (x_diff1 + x_diff2) / 2
-            
-            # Calculate aspect ratio (height/width)
-            aspect_ratio = avg_y_diff / max(avg_x_diff, 0.001)  # Avoid division by zero
-            
-            # Calculate vertical alignment consistency
-            vert_consistency = abs(y_diff1 - y_diff2)
-            
-            # Store edge properties for clustering
-            edge_properties.append([
-                total_length,
-                np.abs(theta_a + theta_b),
-                aspect_ratio,
-                vert_consistency,
-                avg_y_diff
-            ])
+
+    # Offsets of every neighbour from its point, (N, k, 2), scaled per point to [-1, 1]
+    normalized_points = points[indices] - points[:, None, :]
+    scaling_factor = np.max(np.abs(normalized_points), axis=(1, 2))
+    scaling_factor[scaling_factor == 0] = 1
+    scaled_points = normalized_points / scaling_factor[:, None, None]
+
+    # All neighbour pairs (i < j), in the same order as a double loop over the neighbours
+    pair_a, pair_b = np.triu_indices(NUM_NEIGHBOURS, k=1)
+
+    # Cosine similarity of every pair, (N, num_pairs); 0 when one of the offsets is zero
+    scaled_norms = np.linalg.norm(scaled_points, axis=2)
+    norm_products = scaled_norms[:, pair_a] * scaled_norms[:, pair_b]
+    dots = np.sum(scaled_points[:, pair_a] * scaled_points[:, pair_b], axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_similarity = np.where(norm_products == 0, 0.0, dots / norm_products)
+
+    # Non-normalized total length of every pair
+    lengths = np.linalg.norm(normalized_points, axis=2)
+    total_length = lengths[:, pair_a] + lengths[:, pair_b]
+
+    # Select pairs with angles close to 180 degrees (opposite directions) and,
+    # per point, the shortest of them (argmin keeps the first one on ties)
+    is_candidate = cos_similarity < cos_similarity_less_than
+    current_points = np.flatnonzero(is_candidate.any(axis=1))
+    shortest_pair = np.argmin(np.where(is_candidate, total_length, np.inf), axis=1)[current_points]
+
+    neighbour_1 = pair_a[shortest_pair]
+    neighbour_2 = pair_b[shortest_pair]
+    connection_1 = normalized_points[current_points, neighbour_1]
+    connection_2 = normalized_points[current_points, neighbour_2]
+
+    # Two edges per point: to each neighbour of its pair
+    edges = np.empty((2 * len(current_points), 2), dtype=np.int64)
+    edges[:, 0] = np.repeat(current_points, 2)
+    edges[0::2, 1] = indices[current_points, neighbour_1]
+    edges[1::2, 1] = indices[current_points, neighbour_2]
+
+    # Calculate angles with x-axis
+    theta_a = np.degrees(np.arctan2(connection_1[:, 1], connection_1[:, 0]))
+    theta_b = np.degrees(np.arctan2(connection_2[:, 1], connection_2[:, 0]))
+
+    # Calculate feature values for clustering
+    y_diff1 = np.abs(connection_1[:, 1])  # Vertical distance component
+    y_diff2 = np.abs(connection_2[:, 1])
+    avg_y_diff = (y_diff1 + y_diff2) / 2
+
+    x_diff1 = np.abs(connection_1[:, 0])  # Horizontal distance component
+    x_diff2 = np.abs(connection_2[:, 0])
+    avg_x_diff = (x_diff1 + x_diff2) / 2
+
+    # Calculate aspect ratio (height/width)
+    aspect_ratio = avg_y_diff / np.maximum(avg_x_diff, 0.001)  # Avoid division by zero
+
+    # Calculate vertical alignment consistency
+    vert_consistency = np.abs(y_diff1 - y_diff2)
+
+    # Edge properties for clustering, one row per point (i.e. per edge pair)
+    edge_properties = np.stack([
+        total_length[current_points, shortest_pair],
+        np.abs(theta_a + theta_b),
+        aspect_ratio,
+        vert_consistency,
+        avg_y_diff,
+    ], axis=1)
+
+    return edges, edge_properties
+
+
+def generate_layout_graph(points):
+    """
+    Generate a graph representation of text layout based on points.
+    This function implements the core layout analysis logic from the notebook.
+    """
+    edges, edge_properties = compute_layout_edges(points)
     
     # USE THIS IF WE WANT TO KEEP THE OUTLIERS..FOR MAPS
     # Cluster the edges based on their properties
-    # edge_labels = cluster_with_single_majority(np.array(edge_properties))
+    # edge_labels = cluster_with_single_majority(edge_properties)
     
     # # Prepare the final graph structure
     # graph_data = {
@@ -479,10 +721,7 @@ def generate_layout_graph(points):
     #         "label": edge_label
     #     })    
     # return graph_data
-    edge_labels = cluster_with_single_majority(np.array(edge_properties))
-
-    # Create a mask for edges that are not outliers (label != -1)
-    non_outlier_mask = np.array(edge_labels) != -1
+    edge_labels = cluster_with_single_majority(edge_properties)
 
     # Prepare the final graph structure
     graph_data = {
@@ -490,18 +729,14 @@ def generate_layout_graph(points):
         "edges": []
     }
 
-    # Add edges with their labels, filtering out outliers
-    for i, edge in enumerate(edges):
-        # Determine the corresponding edge label using division by 2 (each edge appears twice)
-        label_index = i // 2
-        edge_label = int(edge_labels[label_index])
-        
-        # Only add the edge if it is not an outlier
-        if non_outlier_mask[label_index]:
+    # Add edges with their labels, filtering out outliers. Each label covers an
+    # edge pair, so it applies to edges 2 * i and 2 * i + 1.
+    for (source, target), edge_label in zip(edges.tolist(), np.repeat(edge_labels, 2).tolist()):
+        if edge_label != -1:
             graph_data["edges"].append({
-                "source": int(edge[0]),
-                "target": int(edge[1]),
-                "label": edge_label
+                "source": int(source),
+                "target": int(target),
+                "label": int(edge_label)
             })
 
     return graph_data
@@ -602,11 +837,9 @@ def save_graph_for_gnn(graph_data, manuscript_name, page_number, output_dir='gnn
     data.manuscript = manuscript_name
     data.page = page_number
     
-    # Save PyTorch Geometric data
-    if not update:
-        torch_path = os.path.join(output_dir, f"{manuscript_name}_page{page_number}_graph.pt")
-    else:
-        torch_path = os.path.join(output_dir, f"{manuscript_name}_page{page_number}_graph_updated.pt")
+    # Save PyTorch Geometric data; the edited graph is kept apart from the generated one
+    suffix = "graph_updated" if update else "graph"
+    torch_path = os.path.join(output_dir, f"{manuscript_name}_page{page_number}_{suffix}.pt")
     torch.save(data, torch_path)
     
     # Also save as JSON for compatibility with other frameworks
@@ -622,7 +855,7 @@ def save_graph_for_gnn(graph_data, manuscript_name, page_number, output_dir='gnn
         }
     }
     
-    json_path = os.path.join(output_dir, f"{manuscript_name}_page{page_number}_graph.json")
+    json_path = os.path.join(output_dir, f"{manuscript_name}_page{page_number}_{suffix}.json")
     with open(json_path, 'w') as f:
         json.dump(json_data, f, indent=2)
     
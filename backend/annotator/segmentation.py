@@ -4,6 +4,9 @@ import numpy as np
 import cv2
 import torch
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from scipy.signal import find_peaks
 import torch.nn.functional as F
 from skimage import io
@@ -17,6 +20,11 @@ from packaging import version
 from collections import OrderedDict
 from scipy.ndimage import maximum_filter
 from scipy.ndimage import label
+from PIL import Image
+
+from annotator.inference import inference_context, model_key, prepare_input, prepare_model
+
+CRAFT_MODEL_PATH = "/mnt/cai-data/manuscript-annotation-tool/models/segmentation/craft_mlt_25k.pth"
 
 # #GLOBAL VARIABLES
 # lineheight_baseline_percentile = None
@@ -51,18 +59,18 @@ def heatmap_to_pointcloud(heatmap, min_peak_value=0.3, min_distance=10):
     
     # Label connected components
     labeled_peaks, num_peaks = label(peaks)
-    
-    points = []
-    
-    # For each peak, generate points
-    height = heatmap.shape[0]  # Get the height of the heatmap
-    for peak_idx in range(1, num_peaks + 1):
-        # Get peak location
-        peak_y, peak_x = np.where(labeled_peaks == peak_idx)[0][0], np.where(labeled_peaks == peak_idx)[1][0]
-        points.append([peak_x, peak_y])
-        #points.append([peak_x, height - 1 - peak_y])  # This line is modified
+    if num_peaks == 0:
+        return np.array([])
 
-    return np.array(points)
+    # Each peak is represented by its first pixel in row-major order. Instead of
+    # scanning the whole label image once per peak, look up the first occurrence
+    # of every label in a single pass over the flattened label array.
+    flat_labels = labeled_peaks.ravel()
+    peak_pixels = np.flatnonzero(flat_labels)
+    _, first_pixel = np.unique(flat_labels[peak_pixels], return_index=True)
+    peak_y, peak_x = np.divmod(peak_pixels[first_pixel], heatmap.shape[1])
+
+    return np.stack([peak_x, peak_y], axis=1)
 
 
 # Function Definitions
@@ -318,17 +326,121 @@ def copyStateDict(state_dict):
         new_state_dict[name] = v
     return new_state_dict
 
+# Process-wide CRAFT detector. Building the VGG16-BN backbone and loading the
+# checkpoint takes several seconds, so the detector is loaded once and shared
+# by every request (and worker thread) until it is unloaded, explicitly or
+# after `_detector_idle_seconds` without use (see configure_detector()).
+_detector_lock = threading.Lock()
+_detector = None
+_detector_device = None
+_detector_model_key = None
+_detector_last_used = 0.0
+_detector_idle_seconds = 0
+_detector_idle_timer = None
+
+
+def configure_detector(idle_seconds=None):
+    """idle_seconds (float): unload the detector after this long without use, 0 to keep it loaded."""
+    global _detector_idle_seconds
+    with _detector_lock:
+        if idle_seconds is not None:
+            _detector_idle_seconds = idle_seconds
+        if _detector is not None:
+            _arm_idle_timer(_detector_idle_seconds)
+
+
+def _arm_idle_timer(delay):
+    # called with _detector_lock held
+    global _detector_idle_timer
+    if _detector_idle_timer is not None:
+        _detector_idle_timer.cancel()
+        _detector_idle_timer = None
+    if _detector_idle_seconds > 0:
+        _detector_idle_timer = threading.Timer(delay, _unload_detector_if_idle)
+        _detector_idle_timer.daemon = True
+        _detector_idle_timer.start()
+
+
+def _unload_detector_if_idle():
+    with _detector_lock:
+        if _detector is None or _detector_idle_seconds <= 0:
+            return
+        remaining = _detector_last_used + _detector_idle_seconds - time.time()
+        if remaining > 0:
+            # used since the timer was armed
+            _arm_idle_timer(remaining)
+            return
+        print("Unloading idle CRAFT detector")
+        _clear_detector()
+    torch.cuda.empty_cache()
+
+
+def get_detector(model_path, device=None):
+    """
+    Return the shared CRAFT detector, loading it on first use.
+
+    The detector is put in eval mode and only used under torch.no_grad() or
+    torch.inference_mode() (see annotator.inference), so the same instance can
+    safely serve concurrent Flask worker threads.
+    """
+    global _detector, _detector_device, _detector_model_key, _detector_last_used
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    with _detector_lock:
+        if _detector is None or _detector_device != device or _detector_model_key != model_key():
+            print(f"Loading CRAFT detector from {model_path}")
+            _craft = CRAFT()
+            _craft.load_state_dict(copyStateDict(torch.load(model_path, map_location=device)))
+            detector = torch.nn.DataParallel(_craft).to(device)
+            detector = prepare_model(detector)
+            _detector = detector
+            _detector_device = device
+            _detector_model_key = model_key()
+            _arm_idle_timer(_detector_idle_seconds)
+        _detector_last_used = time.time()
+        return _detector, _detector_device
+
+
+def _clear_detector():
+    # called with _detector_lock held
+    global _detector, _detector_device, _detector_model_key, _detector_last_used, _detector_idle_timer
+    if _detector_idle_timer is not None:
+        _detector_idle_timer.cancel()
+        _detector_idle_timer = None
+    _detector = None
+    _detector_device = None
+    _detector_model_key = None
+    _detector_last_used = 0.0
+
+
+def unload_detector():
+    """Drop the shared CRAFT detector and release its memory. Returns True if one was loaded."""
+    with _detector_lock:
+        loaded = _detector is not None
+        _clear_detector()
+    if loaded:
+        torch.cuda.empty_cache()
+    return loaded
+
+
+def prepare_image(img):
+    """Normalised, channels-first float32 detector input for an RGB leaf."""
+    return np.ascontiguousarray(np.transpose(normalizeMeanVariance(img), (2, 0, 1)))
+
 def detect(img, detector, device):
+    return detect_prepared(prepare_image(img), detector, device)
 
+def detect_prepared(x, detector, device):
 
-        x = [np.transpose(normalizeMeanVariance(img), (2, 0, 1))]
-        x = torch.from_numpy(np.array(x))
-        x = x.to(device)
-        with torch.no_grad():
+
+        x = torch.from_numpy(x[None])
+        x = prepare_input(x.to(device))
+        with inference_context(device):
             y = detector(x)
             
-        region_score = y[0,:,:,0].cpu().data.numpy()
-        affinity_score = y[0,:,:,1].cpu().data.numpy()
+        region_score = y[0,:,:,0].float().cpu().data.numpy()
+        affinity_score = y[0,:,:,1].float().cpu().data.numpy()
 
         # clear GPU memory
         del x
@@ -337,30 +449,187 @@ def detect(img, detector, device):
 
         return region_score,affinity_score
 
-def load_images_from_folder(folder_path):
-    inp_images = []
-    file_names = []
-    
-    # Get all files in the directory
-    files = sorted(os.listdir(folder_path))
-    
-    for file in files:
-        # Check if the file is an image (PNG or JPG)
-        if file.lower().endswith(('.png', '.jpg', '.jpeg','.tif')):
-            try:
-                # Construct the full file path
-                file_path = os.path.join(folder_path, file)
-                
-                # Open the image file
-                image = loadImage(file_path)
-                
-                # Append the image and filename to our lists
-                inp_images.append(image)
-                file_names.append(file)
-            except Exception as e:
-                print(f"Error loading {file}: {str(e)}")
-    
-    return inp_images, file_names
+def list_leaf_files(folder_path):
+    """Sorted file names of the leaf images (PNG, JPG or TIFF) in `folder_path`."""
+    return [file for file in sorted(os.listdir(folder_path)) if file.lower().endswith(('.png', '.jpg', '.jpeg','.tif'))]
+
+def detect_batch(xs, detector, device):
+    """
+    Detect several prepared leaves in one forward pass.
+
+    The leaves are zero-padded (zero is the mean colour after normalisation) to the
+    largest height and width in the batch, and each leaf's scores are cropped back
+    to the (h // 2, w // 2) the detector produces for it alone. Scores next to the
+    padded borders can differ slightly from an unbatched run, so batch leaves of
+    similar size (see plan_detection_batches).
+    """
+    if len(xs) == 1:
+        return [detect_prepared(xs[0], detector, device)]
+
+    height = max(x.shape[1] for x in xs)
+    width = max(x.shape[2] for x in xs)
+    batch = np.zeros((len(xs), 3, height, width), dtype=np.float32)
+    for i, x in enumerate(xs):
+        batch[i, :, :x.shape[1], :x.shape[2]] = x
+
+    batch = prepare_input(torch.from_numpy(batch).to(device))
+    with inference_context(device):
+        y = detector(batch)
+    y = y.float().cpu().data.numpy()
+
+    scores = [
+        (np.copy(y[i, :x.shape[1] // 2, :x.shape[2] // 2, 0]), np.copy(y[i, :x.shape[1] // 2, :x.shape[2] // 2, 1]))
+        for i, x in enumerate(xs)
+    ]
+
+    # clear GPU memory
+    del batch
+    del y
+    torch.cuda.empty_cache()
+
+    return scores
+
+# Rough peak memory of a CRAFT forward pass per input pixel (fp32): the 64-channel
+# full-resolution maps of the first VGG block dominate, plus the U-net skip features
+DETECTOR_BYTES_PER_PIXEL = 1024
+
+def tile_size_for_memory(max_memory_mb, overlap=256):
+    """Largest square tile (a multiple of 32) whose forward pass stays within `max_memory_mb`."""
+    tile_size = int(np.sqrt(max_memory_mb * 1024 ** 2 / DETECTOR_BYTES_PER_PIXEL)) // 32 * 32
+    if tile_size <= 2 * overlap:
+        raise ValueError(f"{max_memory_mb} MB only fits {tile_size}px tiles, too small for an overlap of {overlap}px")
+    return tile_size
+
+def tile_spans(length, tile_size, overlap):
+    """
+    Tiles covering [0, length) along one axis, as (start, end, keep_start, keep_end).
+
+    Consecutive tiles overlap by `overlap` pixels and each keeps its scores up to
+    the middle of the overlap, where both neighbours have the most context.
+    """
+    starts = [0]
+    while starts[-1] + tile_size < length:
+        starts.append(starts[-1] + tile_size - overlap)
+    spans = []
+    for i, start in enumerate(starts):
+        keep_start = 0 if i == 0 else start + overlap // 2
+        keep_end = length if i == len(starts) - 1 else starts[i + 1] + overlap // 2
+        spans.append((start, min(start + tile_size, length), keep_start, keep_end))
+    return spans
+
+def detect_tiled(x, detector, device, tile_size, overlap=256):
+    """
+    Detect a prepared leaf tile by tile, so memory is bounded by `tile_size` instead
+    of the leaf size, and stitch the region and affinity scores back together.
+
+    Tile size and overlap must be multiples of 32 so that every tile lies on the
+    detector's pooling grid; the overlap gives the scores kept from each tile
+    overlap // 2 pixels of real context. A leaf that fits in one tile is detected
+    as a whole.
+    """
+    if tile_size % 32 or overlap % 32 or not 0 <= overlap < tile_size:
+        raise ValueError("tile_size and overlap must be multiples of 32, with overlap < tile_size")
+    height, width = x.shape[1:]
+    if height <= tile_size and width <= tile_size:
+        return detect_prepared(x, detector, device)
+
+    region_score = np.zeros((height // 2, width // 2), dtype=np.float32)
+    affinity_score = np.zeros((height // 2, width // 2), dtype=np.float32)
+    for top, bottom, keep_top, keep_bottom in tile_spans(height, tile_size, overlap):
+        for left, right, keep_left, keep_right in tile_spans(width, tile_size, overlap):
+            tile_region, tile_affinity = detect_prepared(
+                np.ascontiguousarray(x[:, top:bottom, left:right]), detector, device
+            )
+            # all offsets are even, so they map exactly onto the half-resolution scores
+            rows = slice(keep_top // 2, keep_bottom // 2)
+            cols = slice(keep_left // 2, keep_right // 2)
+            tile_rows = slice((keep_top - top) // 2, (keep_bottom - top) // 2)
+            tile_cols = slice((keep_left - left) // 2, (keep_right - left) // 2)
+            region_score[rows, cols] = tile_region[tile_rows, tile_cols]
+            affinity_score[rows, cols] = tile_affinity[tile_rows, tile_cols]
+    return region_score, affinity_score
+
+def leaf_size(folder_path, file_name):
+    """(width, height) of a leaf from its image header, without decoding it; None if unreadable."""
+    try:
+        with Image.open(os.path.join(folder_path, file_name)) as image:
+            return image.size
+    except Exception:
+        return None
+
+def plan_detection_batches(file_names, sizes, batch_size, max_padding=0.15):
+    """
+    Group leaves into detection batches of at most `batch_size` leaves of similar size.
+
+    Leaves are sorted by height and width, and a batch is closed when padding all
+    its leaves to the largest height and width would add more than `max_padding`
+    of their own area. Unreadable leaves (size None) get a batch of their own.
+    """
+    readable = sorted((name for name in file_names if sizes.get(name)), key=lambda name: sizes[name][::-1])
+    batches = [[name] for name in file_names if not sizes.get(name)]
+
+    batch = []
+    for name in readable:
+        candidate = batch + [name]
+        padded_area = len(candidate) * max(sizes[n][0] for n in candidate) * max(sizes[n][1] for n in candidate)
+        area = sum(sizes[n][0] * sizes[n][1] for n in candidate)
+        if batch and (len(candidate) > batch_size or padded_area > (1 + max_padding) * area):
+            batches.append(batch)
+            candidate = [name]
+        batch = candidate
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Line pitch (px between baselines) that detection='auto' scales leaves down to; CRAFT
+# still separates lines reliably at this size and is much faster than on high-DPI scans
+DETECTION_TARGET_LINE_PITCH = 96
+
+def estimate_line_pitch(image):
+    """
+    Dominant distance in pixels between text lines of a leaf, from the autocorrelation
+    of its row-wise ink profile, or None if the profile has no clear period.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    # the pitch is tens of pixels or more, so a reduced copy is enough
+    step = max(1, gray.shape[0] // 1000)
+    profile = 255.0 - gray[::step, ::step].mean(axis=1)
+    profile -= profile.mean()
+    autocorrelation = np.correlate(profile, profile, mode='full')[len(profile) - 1:]
+    if autocorrelation[0] <= 0:
+        return None
+    autocorrelation /= autocorrelation[0]
+    peaks, properties = find_peaks(autocorrelation, height=0.1, prominence=0.1)
+    if len(peaks) == 0:
+        return None
+    return float(peaks[np.argmax(properties['peak_heights'])] * step)
+
+def auto_detection_scale(image, target_line_pitch=DETECTION_TARGET_LINE_PITCH, min_scale=0.25):
+    """Scale that brings the leaf's line pitch down to `target_line_pitch`; leaves are never upscaled."""
+    line_pitch = estimate_line_pitch(image)
+    if line_pitch is None:
+        return 1.0
+    return float(np.clip(target_line_pitch / line_pitch, min_scale, 1.0))
+
+def decode_leaf(folder_path, file_name, detection_scale=1.0):
+    """
+    (image, detector input) of one leaf, or None if it cannot be read.
+
+    The detector input is the leaf resized by `detection_scale`, a factor or 'auto'
+    (see auto_detection_scale); the image itself stays at full resolution.
+    """
+    try:
+        image = loadImage(os.path.join(folder_path, file_name))
+    except Exception as e:
+        print(f"Error loading {file_name}: {str(e)}")
+        return None
+    if detection_scale == 'auto':
+        detection_scale = auto_detection_scale(image)
+    if detection_scale == 1.0:
+        return image, prepare_image(image)
+    height, width = image.shape[:2]
+    size = (max(32, round(width * detection_scale)), max(32, round(height * detection_scale)))
+    return image, prepare_image(cv2.resize(image, size, interpolation=cv2.INTER_AREA))
 
 
 #%%
@@ -501,81 +770,194 @@ def gen_line_images(img2,peaks,bounding_boxes,lines, lineheight_baseline_percent
   return line_images
 
 
-def segment_lines(folder_path, lineheight_baseline_percentile=80, binarize_threshold=100):
-    print(folder_path)
-    #m_name = folder_path.split('/')[-2]
-    m_name = os.path.basename(os.path.dirname(folder_path))
-    device = torch.device('cuda') #change to cpu if no gpu
+def cut_line_images(det, image, lineheight_baseline_percentile, binarize_threshold):
+    """Line images of one leaf, cut out of the leaf using its region score heatmap `det`."""
+    ys = det.sum(axis=1)
+    thres = 0.5 * ys.max()
+    peaks, _ = find_peaks(ys, height=thres,distance=det.shape[0]/100,width=5)
+    bounding_boxes = gen_bounding_boxes(det,peaks, lineheight_baseline_percentile, binarize_threshold)
+    img2 = cv2.cvtColor(cv2.resize(image, det.shape[::-1]), cv2.COLOR_BGR2GRAY)
+
+    lines,peaks1 = assign_lines(bounding_boxes,det)
+    return gen_line_images(img2,peaks1,bounding_boxes,lines, lineheight_baseline_percentile)
 
+def write_page_outputs(manuscript_path, file_name, det, points_twoD):
+    """Write the heatmap and the point cloud of one leaf."""
+    cv2.imwrite(os.path.join(manuscript_path, 'heatmaps', file_name.replace('.tif','.png')), 255*det)
+    np.savetxt(os.path.join(manuscript_path, 'points-2D', f'{os.path.splitext(file_name)[0]}_points.txt'), points_twoD, fmt='%d')
 
-    # HEATMAP
-    inp_images, file_names = load_images_from_folder(folder_path)
+def write_line_images(manuscript_path, file_name, line_images):
+    lines_path = os.path.join(manuscript_path, 'lines', os.path.splitext(file_name)[0])
+    os.makedirs(lines_path, exist_ok=True)
+    for i in range(len(line_images)):
+        cv2.imwrite(os.path.join(lines_path, f'line{i+1:03d}.jpg'), line_images[i])
 
-    _detector = CRAFT()
-    _detector.load_state_dict(copyStateDict(torch.load("/mnt/cai-data/manuscript-annotation-tool/models/segmentation/craft_mlt_25k.pth",map_location=device)))
-    detector = torch.nn.DataParallel(_detector).to(device)
-    detector.eval()
-    st = time.time()
+class StageTimer(object):
+    """Busy time per pipeline stage, summed over the threads running that stage."""
 
-    out_images=[]
-    points = []
-    for image,_filename in zip(inp_images, file_names):
-        # get region score and affinity score
-        region_score, affinity_score = detect(image,detector, device)
-        assert region_score.shape == affinity_score.shape
-        points_twoD = heatmap_to_pointcloud(region_score, min_peak_value=0.3, min_distance=10)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = OrderedDict()
 
-        points.append(points_twoD)
-        out_images.append(np.copy(region_score))
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
 
+    def run(self, stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+def finish_page(manuscript_path, file_name, image, det, lineheight_baseline_percentile, binarize_threshold, timer):
+    """Point cloud, line cut and all the writes of one detected leaf (runs on the writer pool)."""
+    # scores of a leaf detected at reduced scale are brought back to half of the leaf's
+    # resolution, which is what the points, boxes and line cuts are expressed in
+    half_size = (image.shape[1] // 2, image.shape[0] // 2)
+    if det.shape[::-1] != half_size:
+        det = timer.run("points", cv2.resize, det, half_size, interpolation=cv2.INTER_LINEAR)
+    points_twoD = timer.run("points", heatmap_to_pointcloud, det, 0.3, 10)
+    timer.run("write", write_page_outputs, manuscript_path, file_name, det, points_twoD)
+    try:
+        line_images = timer.run("lines", cut_line_images, det, image, lineheight_baseline_percentile, binarize_threshold)
+    except Exception:
+        print(f"segmentation fails: {file_name}")
+        with open(os.path.join(manuscript_path, 'points-2D', 'failures.txt'), 'a') as file:
+            file.write(f"{file_name}\n")
+        black_image = np.zeros((50, 900, 3), dtype=np.uint8)
+        line_images = [black_image] * 5
+    timer.run("write", write_line_images, manuscript_path, file_name, line_images)
+
+def segment_lines(folder_path, lineheight_baseline_percentile=80, binarize_threshold=100, model_path=CRAFT_MODEL_PATH, progress_callback=None,
+                  decode_workers=2, write_workers=2, prefetch=2, detect_batch_size=1,
+                  tile_size=None, tile_overlap=256, max_detector_memory_mb=None, detection_scale=1.0):
+    """
+    Segment every leaf in `folder_path` (<manuscript>/leaves) into line images.
 
-    if os.path.exists(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/heatmaps') == False:
-        os.makedirs(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/heatmaps')
+    Pages go through a three-stage pipeline so the detector does not wait on I/O:
+    a decode pool reads and normalises up to `prefetch` leaves ahead, the detector
+    runs on the calling thread, and a writer pool computes the point cloud, cuts
+    the lines and writes the heatmap, points and line images of each page. At most
+    `prefetch` decoded and `write_workers` + 1 detected pages are held in memory.
 
-    if os.path.exists(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/points-2D') == False:
-        os.makedirs(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/points-2D')
+    With `detect_batch_size` > 1, leaves of similar size are detected together in
+    batches of up to that many leaves (see detect_batch), which keeps a GPU or all
+    CPU cores busier than one leaf per forward pass. Leaves are then processed in
+    size order rather than file order.
 
-    for _img,_filename in zip(out_images,file_names):
-        cv2.imwrite(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/heatmaps/{_filename.replace('.tif','.png')}',255*_img)
-    for points_twoD,_filename in zip(points,file_names):
-        np.savetxt(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/points-2D/{os.path.splitext(_filename)[0]}_points.txt', points_twoD, fmt='%d')
-    
-    print(f"{time.time()-st:.2f} seconds elapsed.....")
+    With `tile_size`, or a `max_detector_memory_mb` ceiling from which the tile size
+    is derived, leaves larger than a tile are detected tile by tile (see
+    detect_tiled). Tiling bounds memory per forward pass, so it disables batching.
+
+    `detection_scale` runs the detector on leaves resized by that factor, or by a
+    per-leaf factor estimated from the line pitch with 'auto'. The scores are then
+    resized back, so all outputs keep the coordinates of full-scale detection.
 
+    progress_callback (callable): optional, called as progress_callback("segmentation", done, total)
+        each time a page has been written. It may raise to abort.
 
-    # ALGORITHM
-    for det,image,file_name in zip(out_images,inp_images,file_names):
-        print(file_name)
-        ys = det.sum(axis=1)
-        thres = 0.5 * ys.max()
+    Returns the busy seconds of each stage ("decode", "detect", "points", "lines",
+    "write"), the time the detector waited for a decoded leaf ("detect_wait") and
+    the wall-clock time ("total").
+    """
+    print(folder_path)
+    manuscript_path = os.path.dirname(folder_path)
+    os.makedirs(os.path.join(manuscript_path, 'heatmaps'), exist_ok=True)
+    os.makedirs(os.path.join(manuscript_path, 'points-2D'), exist_ok=True)
+
+    file_names = list_leaf_files(folder_path)
+    if max_detector_memory_mb:
+        memory_tile_size = tile_size_for_memory(max_detector_memory_mb, tile_overlap)
+        tile_size = min(tile_size, memory_tile_size) if tile_size else memory_tile_size
+    if tile_size:
+        detect_batch_size = 1
+    if detect_batch_size > 1:
+        sizes = {file_name: leaf_size(folder_path, file_name) for file_name in file_names}
+        batches = plan_detection_batches(file_names, sizes, detect_batch_size)
+        prefetch = max(prefetch, detect_batch_size)
+    else:
+        batches = [[file_name] for file_name in file_names]
+    detector, device = get_detector(model_path)
+    timer = StageTimer()
+    st = time.perf_counter()
+
+    pending_decodes = deque()
+    pending_writes = deque()
+    pages_done = 0
+
+    def page_done():
+        nonlocal pages_done
+        pages_done += 1
+        if progress_callback is not None:
+            progress_callback("segmentation", pages_done, len(file_names))
+
+    def page_finished(future):
+        future.result()
+        page_done()
+
+    with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="segment-decode") as decode_pool, \
+            ThreadPoolExecutor(max_workers=write_workers, thread_name_prefix="segment-write") as write_pool:
         try:
-            peaks, _ = find_peaks(ys, height=thres,distance=det.shape[0]/100,width=5)
-            bounding_boxes = gen_bounding_boxes(det,peaks, lineheight_baseline_percentile, binarize_threshold)
-            img2 = cv2.cvtColor(cv2.resize(image, det.shape[::-1]), cv2.COLOR_BGR2GRAY)
-            
-            lines,peaks1 = assign_lines(bounding_boxes,det)
-            line_images = gen_line_images(img2,peaks1,bounding_boxes,lines, lineheight_baseline_percentile)
-
-            if os.path.exists(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/lines/{os.path.splitext(file_name)[0]}') == False:
-                os.makedirs(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/lines/{os.path.splitext(file_name)[0]}')
-            for i in range(len(line_images)):
-                cv2.imwrite(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/lines/{os.path.splitext(file_name)[0]}/line{i+1:03d}.jpg',line_images[i])
-        except:
-            print("segmentation fails")
-            with open(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/points-2D/failures.txt', 'a') as file:
-                file.write(f"{file_name}")
-
-            if os.path.exists(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/lines/{os.path.splitext(file_name)[0]}') == False:
-                os.makedirs(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/lines/{os.path.splitext(file_name)[0]}')
-            black_image = np.zeros((50, 900, 3), dtype=np.uint8)
-            for i in range(5):
-                cv2.imwrite(f'/mnt/cai-data/manuscript-annotation-tool/manuscripts/{m_name}/lines/{os.path.splitext(file_name)[0]}/line{i+1:03d}.jpg',black_image)
-    
-    # clear GPU memory
-    del detector
-    del _detector
+            leaves = iter([file_name for batch in batches for file_name in batch])
+            for file_name in leaves:
+                pending_decodes.append((file_name, decode_pool.submit(timer.run, "decode", decode_leaf, folder_path, file_name, detection_scale)))
+                if len(pending_decodes) >= max(1, prefetch):
+                    break
+
+            for batch in batches:
+                decoded_batch = []
+                for _ in batch:
+                    file_name, decoding = pending_decodes.popleft()
+                    wait_start = time.perf_counter()
+                    decoded = decoding.result()
+                    timer.add("detect_wait", time.perf_counter() - wait_start)
+
+                    # keep the decode pool busy while the detector runs
+                    next_file_name = next(leaves, None)
+                    if next_file_name is not None:
+                        pending_decodes.append((next_file_name, decode_pool.submit(timer.run, "decode", decode_leaf, folder_path, next_file_name, detection_scale)))
+
+                    if decoded is None:
+                        page_done()
+                        continue
+                    decoded_batch.append((file_name,) + decoded)
+                    del decoded
+                if not decoded_batch:
+                    continue
+
+                if tile_size:
+                    scores = [timer.run("detect", detect_tiled, x, detector, device, tile_size, tile_overlap) for _, _, x in decoded_batch]
+                else:
+                    scores = timer.run("detect", detect_batch, [x for _, _, x in decoded_batch], detector, device)
+                for (file_name, image, _), (region_score, affinity_score) in zip(decoded_batch, scores):
+                    assert region_score.shape == affinity_score.shape
+
+                    # bound the number of detected pages waiting for the writers
+                    while len(pending_writes) > write_workers:
+                        page_finished(pending_writes.popleft())
+                    pending_writes.append(write_pool.submit(
+                        finish_page, manuscript_path, file_name, image, region_score,
+                        lineheight_baseline_percentile, binarize_threshold, timer,
+                    ))
+                del decoded_batch, scores, image, region_score, affinity_score
+                while pending_writes and pending_writes[0].done():
+                    page_finished(pending_writes.popleft())
+
+            while pending_writes:
+                page_finished(pending_writes.popleft())
+        except BaseException:
+            for _, future in pending_decodes:
+                future.cancel()
+            for future in pending_writes:
+                future.cancel()
+            raise
+
+    timings = dict(timer.seconds, total=time.perf_counter() - st)
+
+    # the detector itself stays resident, see get_detector()
     torch.cuda.empty_cache()
-
+    return timings
 
 # Create the arg parser
 # parser = argparse.ArgumentParser(description="A simple script to process a path")
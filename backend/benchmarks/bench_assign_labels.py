@@ -0,0 +1,109 @@
+"""
+Equivalence check and benchmark of manual_segmentation.assign_labels against
+the previous implementation, which scanned every point for every contour
+box, on synthetic dense pages: rows of word boxes with a few tall
+boxes spanning two lines, and labelled points along the lines.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_assign_labels [--lines 40 80] [--words-per-line 40] [--points-per-word 4]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from annotator.manual_segmentation import assign_labels, render_segmentation_overlay
+
+
+def assign_labels_reference(bounding_boxes, points, labels):
+    """ previous implementation (assign_labels_and_plot without the drawing): O(boxes x points) """
+    labeled_bboxes = []
+    for bbox in bounding_boxes:
+        x_min, y_min, w, h = bbox
+        x_max, y_max = x_min + w, y_min + h
+        pts_in_bbox = [
+            (px, py, lab)
+            for (px, py), lab in zip(points, labels)
+            if x_min <= px <= x_max and y_min <= py <= y_max
+        ]
+        if pts_in_bbox and len({lab for (_, _, lab) in pts_in_bbox}) == 1:
+            labeled_bboxes.append((x_min, y_min, w, h, pts_in_bbox[0][2]))
+        elif pts_in_bbox:
+            pts_in_bbox.sort(key=lambda p: p[1])
+            boundaries = [y_min]
+            prev_label = pts_in_bbox[0][2]
+            for i in range(1, len(pts_in_bbox)):
+                current_label = pts_in_bbox[i][2]
+                if current_label != prev_label:
+                    boundary = int((pts_in_bbox[i-1][1] + pts_in_bbox[i][1]) / 2)
+                    boundary = max(boundary, y_min)
+                    boundary = min(boundary, y_max)
+                    boundaries.append(boundary)
+                    prev_label = current_label
+            boundaries.append(y_max)
+            for idx in range(1, len(boundaries)):
+                seg_top = boundaries[idx - 1]
+                seg_bottom = boundaries[idx]
+                seg_label = None
+                for (px, py, lab) in pts_in_bbox:
+                    if seg_top <= py <= seg_bottom:
+                        seg_label = lab
+                        break
+                if seg_label is not None:
+                    labeled_bboxes.append((x_min, seg_top, w, seg_bottom - seg_top, seg_label))
+    return labeled_bboxes
+
+
+def synthetic_page(num_lines, words_per_line, points_per_word, seed=0, line_pitch=40, width=3000):
+    rng = np.random.default_rng(seed)
+    boxes, points, labels = [], [], []
+    word_width = width // words_per_line
+    for line in range(num_lines):
+        y = 20 + line * line_pitch
+        for word in range(words_per_line):
+            x = word * word_width + int(rng.integers(0, 5))
+            w = word_width - 8
+            # a few boxes touching the next line, which have to be split
+            h = 2 * line_pitch - 10 if rng.random() < 0.05 and line < num_lines - 1 else line_pitch - 12
+            boxes.append((x, y, w, h))
+            for _ in range(points_per_word):
+                points.append((x + int(rng.integers(0, w)), y + int(rng.integers(4, line_pitch - 16))))
+                labels.append(line + 1)
+    return boxes, np.array(points), np.array(labels), (20 + num_lines * line_pitch, width)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, nargs="+", default=[40, 80])
+    parser.add_argument("--words-per-line", type=int, default=40)
+    parser.add_argument("--points-per-word", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'boxes':>7} {'points':>7} {'reference (s)':>14} {'assign_labels (s)':>18} {'overlay (s)':>12}")
+        for num_lines in args.lines:
+            boxes, points, labels, shape = synthetic_page(num_lines, args.words_per_line, args.points_per_word)
+            image = np.full(shape, 200, dtype=np.uint8)
+
+            start = time.perf_counter()
+            expected = assign_labels_reference(boxes, points, labels)
+            t_reference = time.perf_counter() - start
+
+            start = time.perf_counter()
+            labeled = assign_labels(boxes, points, labels)
+            t_new = time.perf_counter() - start
+            assert labeled == expected, "labelled boxes differ from the reference"
+
+            start = time.perf_counter()
+            render_segmentation_overlay(image, boxes, labeled, points, labels, os.path.join(tmp, "overlay.jpg"))
+            t_overlay = time.perf_counter() - start
+            assert cv2.imread(os.path.join(tmp, "overlay.jpg")) is not None
+            print(f"{len(boxes):7d} {len(points):7d} {t_reference:14.3f} {t_new:18.3f} {t_overlay:12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of recognition.beam_search.ctc_beam_search against the pure-Python
+finetune.utils.ctcBeamSearch, on synthetic CTC outputs of known lines: noisy,
+peaked distributions over the charset of the recognition models, with runs
+of repeats and blanks. Reports the time per line and the character error
+rate of greedy decoding and of both beam searches, with and without a
+character n-gram model trained on other synthetic lines.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_beam_search [--lines 20] [--steps 500] [--beam-width 8]
+"""
+import argparse
+import time
+
+import numpy as np
+from nltk.metrics.distance import edit_distance
+
+from annotator.finetune.utils import ctcBeamSearch
+from annotator.recognition.beam_search import CharNgramLM, ctc_beam_search
+from annotator.recognition.recognition import RECOGNITION_OPTIONS
+
+
+WORDS = ["manuscript", "leaf", "line", "text", "annotation", "grantha", "sutra", "commentary", "verse", "folio"]
+
+
+def random_line(rng, length=40):
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(WORDS[rng.integers(len(WORDS))])
+    return " ".join(words)
+
+
+def synthetic_log_probs(text, index, num_class, steps, rng, noise=2.5):
+    """ log-softmax frames spelling `text`: each character for a few frames, blanks in between """
+    labels = []
+    for char in text:
+        labels += [index[char]] * rng.integers(1, 4) + [0] * rng.integers(1, 4)
+    labels = (labels + [0] * steps)[:steps]
+    logits = rng.normal(0, 1, (steps, num_class))
+    logits[np.arange(steps), labels] += noise + rng.normal(0, 1.5, steps)
+    logits -= logits.max(axis=1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+
+def greedy(log_probs):
+    best = log_probs.argmax(axis=1)
+    return [label for i, label in enumerate(best) if label != 0 and (i == 0 or best[i - 1] != label)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--steps", type=int, default=500, help="time steps per line, ~imgW/4")
+    parser.add_argument("--beam-width", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=16)
+    parser.add_argument("--skip-reference", action="store_true", help="do not run the slow finetune beam search")
+    args = parser.parse_args()
+
+    character = RECOGNITION_OPTIONS["character"]
+    classes = ["[blank]"] + list(character)
+    index = {char: i + 1 for i, char in enumerate(character)}
+    rng = np.random.default_rng(0)
+    lm = CharNgramLM(character, [random_line(rng) for _ in range(500)], order=4)
+
+    texts = [random_line(rng) for _ in range(args.lines)]
+    outputs = [synthetic_log_probs(text, index, len(classes), args.steps, rng) for text in texts]
+
+    def to_text(labels):
+        return "".join(classes[label] for label in labels)
+
+    decoders = {
+        "greedy": lambda log_probs: to_text(greedy(log_probs)),
+        "beam search": lambda log_probs: to_text(
+            ctc_beam_search(log_probs, beam_width=args.beam_width, top_k=args.top_k)),
+        "beam search + LM": lambda log_probs: to_text(
+            ctc_beam_search(log_probs, beam_width=args.beam_width, top_k=args.top_k, lm=lm)),
+    }
+    if not args.skip_reference:
+        decoders["finetune ctcBeamSearch"] = lambda log_probs: ctcBeamSearch(
+            np.exp(log_probs), classes, [0], None, beamWidth=args.beam_width)
+
+    print(f"{len(texts)} lines of {args.steps} steps, {len(classes)} classes")
+    print(f"{'decoder':>24} {'ms / line':>10} {'CER':>8}")
+    for name, decoder in decoders.items():
+        start = time.perf_counter()
+        predictions = [decoder(log_probs) for log_probs in outputs]
+        elapsed = time.perf_counter() - start
+        errors = sum(edit_distance(prediction, text) for prediction, text in zip(predictions, texts))
+        cer = errors / sum(len(text) for text in texts)
+        print(f"{name:>24} {1000 * elapsed / len(texts):10.1f} {cer:8.4f}")
+
+
+if __name__ == "__main__":
+    main()
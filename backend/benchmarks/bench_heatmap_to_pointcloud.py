@@ -0,0 +1,78 @@
+"""
+Benchmark of segmentation.heatmap_to_pointcloud against the previous
+per-peak implementation, on synthetic heatmaps with 1k to 50k peaks.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_heatmap_to_pointcloud
+
+The previous implementation is O(num_peaks x H x W), so by default it is only
+timed up to --max-reference-peaks peaks.
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, label, maximum_filter
+
+from annotator.segmentation import heatmap_to_pointcloud
+
+
+def heatmap_to_pointcloud_reference(heatmap, min_peak_value=0.3, min_distance=10):
+    """ previous implementation, one pair of np.where scans per peak """
+    heatmap_norm = (heatmap - heatmap.min()) / (heatmap.max() - heatmap.min())
+    local_max = maximum_filter(heatmap_norm, size=min_distance)
+    peaks = (heatmap_norm == local_max) & (heatmap_norm > min_peak_value)
+    labeled_peaks, num_peaks = label(peaks)
+    points = []
+    for peak_idx in range(1, num_peaks + 1):
+        peak_y, peak_x = np.where(labeled_peaks == peak_idx)[0][0], np.where(labeled_peaks == peak_idx)[1][0]
+        points.append([peak_x, peak_y])
+    return np.array(points)
+
+
+def synthetic_heatmap(num_peaks, spacing=14, seed=0):
+    """ jittered grid of gaussian blobs, roughly like a CRAFT region score of a dense leaf """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(num_peaks)))
+    size = side * spacing + spacing
+    heatmap = np.zeros((size, size), dtype=np.float32)
+    grid = np.arange(side) * spacing + spacing // 2
+    ys, xs = np.meshgrid(grid, grid, indexing="ij")
+    ys = (ys.ravel() + rng.integers(-2, 3, ys.size))[:num_peaks]
+    xs = (xs.ravel() + rng.integers(-2, 3, xs.size))[:num_peaks]
+    heatmap[ys, xs] = rng.uniform(0.5, 1.0, num_peaks)
+    return gaussian_filter(heatmap, sigma=2)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 20000, 50000])
+    parser.add_argument("--max-reference-peaks", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'peaks':>8} {'shape':>12} {'found':>8} {'vectorised (s)':>15} {'reference (s)':>14} {'speedup':>8}")
+    for num_peaks in args.sizes:
+        heatmap = synthetic_heatmap(num_peaks)
+        points, t_new = timed(heatmap_to_pointcloud, heatmap)
+
+        if num_peaks <= args.max_reference_peaks:
+            reference, t_ref = timed(heatmap_to_pointcloud_reference, heatmap)
+            assert reference.dtype == points.dtype and np.array_equal(reference, points), \
+                "vectorised output differs from the reference implementation"
+            ref_col, speedup = f"{t_ref:14.3f}", f"{t_ref / t_new:7.0f}x"
+        else:
+            ref_col, speedup = f"{'skipped':>14}", f"{'-':>8}"
+
+        shape = f"{heatmap.shape[0]}x{heatmap.shape[1]}"
+        print(f"{num_peaks:>8} {shape:>12} {len(points):>8} {t_new:15.4f} {ref_col} {speedup}")
+
+
+if __name__ == "__main__":
+    main()
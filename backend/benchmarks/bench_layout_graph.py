@@ -0,0 +1,119 @@
+"""
+Equivalence check and benchmark of routes.compute_layout_edges /
+routes.generate_layout_graph against the previous per-point implementation,
+on synthetic pages of text-line points.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_layout_graph
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from annotator.routes import cluster_with_single_majority, compute_layout_edges, generate_layout_graph
+
+
+def layout_edges_reference(points):
+    """ previous implementation: a python double loop over the 28 neighbour pairs of every point """
+    NUM_NEIGHBOURS = 8
+    cos_similarity_less_than = -0.8
+
+    tree = cKDTree(points)
+    _, indices = tree.query(points, k=NUM_NEIGHBOURS)
+    edges = []
+    edge_properties = []
+    for current_point_index, nbr_indices in enumerate(indices):
+        normalized_points = np.array(points)[nbr_indices] - np.array(points)[current_point_index]
+        scaling_factor = np.max(np.abs(normalized_points))
+        if scaling_factor == 0:
+            scaling_factor = 1
+        scaled_points = normalized_points / scaling_factor
+        relative_neighbours = list(zip(nbr_indices, scaled_points, normalized_points))
+
+        filtered_neighbours = []
+        for i, neighbor1 in enumerate(relative_neighbours):
+            for neighbor2 in relative_neighbours[i + 1:]:
+                if np.linalg.norm(neighbor1[1]) * np.linalg.norm(neighbor2[1]) == 0:
+                    cos_similarity = 0.0
+                else:
+                    cos_similarity = np.dot(neighbor1[1], neighbor2[1]) / (
+                        np.linalg.norm(neighbor1[1]) * np.linalg.norm(neighbor2[1])
+                    )
+                total_length = np.linalg.norm(neighbor1[2]) + np.linalg.norm(neighbor2[2])
+                if cos_similarity < cos_similarity_less_than:
+                    filtered_neighbours.append((neighbor1, neighbor2, total_length, cos_similarity))
+
+        if filtered_neighbours:
+            connection_1, connection_2, total_length, _ = min(filtered_neighbours, key=lambda x: x[2])
+            theta_a = np.degrees(np.arctan2(connection_1[2][1], connection_1[2][0]))
+            theta_b = np.degrees(np.arctan2(connection_2[2][1], connection_2[2][0]))
+            edges.append([current_point_index, connection_1[0]])
+            edges.append([current_point_index, connection_2[0]])
+            y_diff1 = abs(connection_1[2][1])
+            y_diff2 = abs(connection_2[2][1])
+            avg_y_diff = (y_diff1 + y_diff2) / 2
+            x_diff1 = abs(connection_1[2][0])
+            x_diff2 = abs(connection_2[2][0])
+            avg_x_diff = (x_diff1 + x_diff2) / 2
+            aspect_ratio = avg_y_diff / max(avg_x_diff, 0.001)
+            vert_consistency = abs(y_diff1 - y_diff2)
+            edge_properties.append([total_length, np.abs(theta_a + theta_b), aspect_ratio, vert_consistency, avg_y_diff])
+
+    return np.array(edges, dtype=np.int64).reshape(-1, 2), np.array(edge_properties).reshape(-1, 5)
+
+
+def layout_graph_reference(points):
+    edges, edge_properties = layout_edges_reference(points)
+    edge_labels = cluster_with_single_majority(edge_properties)
+    return {
+        "nodes": [{"id": i, "x": float(point[0]), "y": float(point[1])} for i, point in enumerate(points)],
+        "edges": [
+            {"source": int(edge[0]), "target": int(edge[1]), "label": int(edge_labels[i // 2])}
+            for i, edge in enumerate(edges)
+            if edge_labels[i // 2] != -1
+        ],
+    }
+
+
+def synthetic_points(num_points, seed=0):
+    """ akshara-like points on slightly slanted text lines, plus a little noise """
+    rng = np.random.default_rng(seed)
+    per_line = 60
+    num_lines = int(np.ceil(num_points / per_line))
+    xs = np.tile(np.arange(per_line) * 15.0, num_lines) + rng.normal(0, 2, per_line * num_lines)
+    ys = np.repeat(np.arange(num_lines) * 40.0, per_line) + 0.02 * xs + rng.normal(0, 2, per_line * num_lines)
+    points = np.round(np.stack([xs, ys], axis=1)[:num_points])
+    return points.tolist()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 5000, 10000])
+    args = parser.parse_args()
+
+    print(f"{'points':>8} {'edges':>8} {'batched (s)':>12} {'reference (s)':>14} {'speedup':>8}")
+    for num_points in args.sizes:
+        points = synthetic_points(num_points)
+
+        (edges, edge_properties), t_new = timed(compute_layout_edges, points)
+        (ref_edges, ref_properties), t_ref = timed(layout_edges_reference, points)
+        assert np.array_equal(edges, ref_edges), "edges differ from the reference implementation"
+        assert np.allclose(edge_properties, ref_properties, rtol=1e-12, atol=1e-12), \
+            "edge features differ from the reference implementation"
+        assert generate_layout_graph(points) == layout_graph_reference(points), \
+            "graph differs from the reference implementation"
+
+        print(f"{num_points:>8} {len(edges):>8} {t_new:12.4f} {t_ref:14.3f} {t_ref / t_new:7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Equivalence check of the batched CTC greedy decoding (recognition.utils.
+ctc_greedy_collapse, used by the CTCLabelConverters of recognition and
+finetune) against the per-step Python loops it replaced, on random argmax
+indices with long runs of repeats and blanks.
+
+Run from the backend directory:
+
+    python -m benchmarks.check_ctc_decode [--batches 50] [--batch-size 32] [--steps 500]
+"""
+import argparse
+import time
+
+import torch
+
+from annotator.finetune.utils import CTCLabelConverter as FinetuneCTCLabelConverter
+from annotator.recognition.utils import CTCLabelConverter, CTCLabelConverterForBaiduWarpctc
+
+
+def reference_decode(converter, text_index, length):
+    """ recognition.utils.CTCLabelConverter.decode before batching """
+    texts = []
+    for index, l in enumerate(length):
+        t = text_index[index, :]
+        char_list = []
+        for i in range(l):
+            if t[i] != 0 and (not (i > 0 and t[i - 1] == t[i])):
+                char_list.append(converter.character[t[i]])
+        texts.append(''.join(list(filter((" ").__ne__, char_list))))
+    return texts
+
+
+def reference_decode_flat(converter, text_index, length, ignore_idx=(0,)):
+    """ CTCLabelConverterForBaiduWarpctc.decode / finetune decode_greedy before batching """
+    texts = []
+    index = 0
+    for l in length:
+        t = text_index[index:index + l]
+        char_list = []
+        for i in range(l):
+            if t[i] not in ignore_idx and (not (i > 0 and t[i - 1] == t[i])):
+                char_list.append(converter.character[t[i]])
+        texts.append(''.join(char_list))
+        index += l
+    return texts
+
+
+def random_indices(batch_size, steps, num_class, generator):
+    """ argmax-like indices: runs of one class, mostly blanks """
+    runs = torch.randint(1, 6, (batch_size, steps), generator=generator)
+    classes = torch.randint(0, num_class, (batch_size, steps), generator=generator)
+    classes[torch.rand(batch_size, steps, generator=generator) < 0.5] = 0
+    rows = [torch.repeat_interleave(c, r)[:steps] for c, r in zip(classes, runs)]
+    return torch.stack(rows)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=500, help="time steps per line, ~imgW/4")
+    args = parser.parse_args()
+
+    character = "0123456789abcdefghijklmnopqrstuvwxyz .,-"
+    converter = CTCLabelConverter(character)
+    baidu_converter = CTCLabelConverterForBaiduWarpctc(character)
+    finetune_converter = FinetuneCTCLabelConverter(character)
+    generator = torch.Generator().manual_seed(0)
+
+    t_reference = t_batched = 0.0
+    for _ in range(args.batches):
+        text_index = random_indices(args.batch_size, args.steps, len(converter.character), generator)
+        full = torch.IntTensor([args.steps] * args.batch_size)
+        partial = torch.randint(0, args.steps + 1, (args.batch_size,), generator=generator, dtype=torch.int32)
+
+        for length in (full, partial):
+            expected, t_ref = timed(reference_decode, converter, text_index, length)
+            texts, t_new = timed(converter.decode, text_index, length)
+            assert texts == expected, "CTCLabelConverter.decode differs from the reference"
+            t_reference += t_ref
+            t_batched += t_new
+
+        flat = torch.cat([row[:l] for row, l in zip(text_index, partial)])
+        expected = reference_decode_flat(baidu_converter, flat, partial)
+        assert baidu_converter.decode(flat, partial) == expected, "CTCLabelConverterForBaiduWarpctc.decode differs"
+
+        expected = reference_decode_flat(finetune_converter, text_index.view(-1), full, finetune_converter.ignore_idx)
+        assert finetune_converter.decode_greedy(text_index, full) == expected, "finetune decode_greedy differs (2D)"
+        assert finetune_converter.decode_greedy(text_index.view(-1), full) == expected, "finetune decode_greedy differs"
+
+    print(f"{args.batches} batches of {args.batch_size}x{args.steps}: identical output")
+    print(f"CTCLabelConverter.decode: loop {t_reference:.2f}s, batched {t_batched:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
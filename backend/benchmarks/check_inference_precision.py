@@ -0,0 +1,132 @@
+"""
+Accuracy regression check of reduced-precision / channels-last inference
+(annotator.inference) against fp32 NCHW, for the recognition model on a set
+of line images and for the CRAFT detector on a set of leaves.
+
+Run from the backend directory:
+
+    python -m benchmarks.check_inference_precision \
+        --model instance/models/recognition/<model>.pth --lines <folder of line images> \
+        [--labels labels.csv] [--leaves <folder of leaves>] [--dtype bfloat16] [--channels-last]
+
+--labels is a CSV in the fine-tuning format (filename,words) used to report
+the accuracy of both runs against the ground truth. The check fails if the
+character error rate of the candidate against the fp32 predictions exceeds
+--max-cer, or the detector's region scores differ by more than
+--max-region-diff.
+"""
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+import torch
+from nltk.metrics.distance import edit_distance
+
+from annotator import inference
+from annotator.recognition.demo import recognise_lines
+from annotator.recognition.recognition import RECOGNITION_OPTIONS
+from annotator.segmentation import (
+    CRAFT_MODEL_PATH, detect, get_detector, heatmap_to_pointcloud, list_leaf_files, loadImage,
+)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def recognise(lines_folder, model_path):
+    results = recognise_lines(image_folder=lines_folder, saved_model=model_path, **RECOGNITION_OPTIONS)
+    return {result["image_path"]: result for result in results}
+
+
+def character_error_rate(predictions, references):
+    errors = sum(edit_distance(pred, ref) for pred, ref in zip(predictions, references))
+    return errors / max(1, sum(len(ref) for ref in references))
+
+
+def check_recognition(args, candidate):
+    inference.configure(dtype="float32", channels_last=False)
+    recognise(args.lines, args.model)  # warm-up: loads the model and the kernels
+    reference, t_ref = timed(recognise, args.lines, args.model)
+    inference.configure(**candidate)
+    recognise(args.lines, args.model)
+    results, t_new = timed(recognise, args.lines, args.model)
+
+    paths = sorted(reference)
+    ref_preds = [reference[path]["predicted_label"] for path in paths]
+    new_preds = [results[path]["predicted_label"] for path in paths]
+    cer = character_error_rate(new_preds, ref_preds)
+    same = sum(ref == new for ref, new in zip(ref_preds, new_preds))
+    confidence_diff = max(
+        (abs(reference[path]["confidence_score"] - results[path]["confidence_score"]) for path in paths), default=0.0
+    )
+    print(f"recognition: {len(paths)} lines, fp32 {t_ref:.2f}s, candidate {t_new:.2f}s")
+    print(f"  identical predictions: {same}/{len(paths)}, CER vs fp32: {cer:.4f}, max |d confidence|: {confidence_diff:.4f}")
+
+    if args.labels:
+        with open(args.labels, newline="", encoding="utf-8") as f:
+            labels = {row["filename"]: row["words"] for row in csv.DictReader(f)}
+        labelled = [path for path in paths if os.path.basename(path) in labels]
+        truth = [labels[os.path.basename(path)] for path in labelled]
+        print(f"  CER vs ground truth ({len(labelled)} lines): "
+              f"fp32 {character_error_rate([reference[p]['predicted_label'] for p in labelled], truth):.4f}, "
+              f"candidate {character_error_rate([results[p]['predicted_label'] for p in labelled], truth):.4f}")
+
+    return cer <= args.max_cer
+
+
+def check_detection(args, candidate):
+    file_names = list_leaf_files(args.leaves)[:args.max_leaves]
+    leaves = [loadImage(os.path.join(args.leaves, file_name)) for file_name in file_names]
+
+    def run():
+        detector, device = get_detector(args.craft_model)
+        detect(leaves[0], detector, device)  # warm-up
+        return timed(lambda: [detect(leaf, detector, device)[0] for leaf in leaves])
+
+    inference.configure(dtype="float32", channels_last=False)
+    reference, t_ref = run()
+    inference.configure(**candidate)
+    scores, t_new = run()
+
+    max_diff = max(float(np.abs(ref - new).max()) for ref, new in zip(reference, scores))
+    same_points = sum(
+        np.array_equal(heatmap_to_pointcloud(ref), heatmap_to_pointcloud(new)) for ref, new in zip(reference, scores)
+    )
+    print(f"detection: {len(leaves)} leaves, fp32 {t_ref:.2f}s, candidate {t_new:.2f}s")
+    print(f"  max |d region score|: {max_diff:.4f}, identical point clouds: {same_points}/{len(leaves)}")
+    return max_diff <= args.max_region_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="recognition checkpoint")
+    parser.add_argument("--lines", help="folder of line images (searched recursively)")
+    parser.add_argument("--labels", help="CSV with filename,words ground truth for the line images")
+    parser.add_argument("--leaves", help="folder of leaf images for the detector check")
+    parser.add_argument("--max-leaves", type=int, default=5)
+    parser.add_argument("--craft-model", default=CRAFT_MODEL_PATH)
+    parser.add_argument("--dtype", default="bfloat16", choices=list(inference.INFERENCE_DTYPES))
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--max-cer", type=float, default=0.005)
+    parser.add_argument("--max-region-diff", type=float, default=0.05)
+    args = parser.parse_args()
+
+    candidate = {"dtype": args.dtype, "channels_last": args.channels_last}
+    print(f"candidate: {candidate}, torch {torch.__version__}, {torch.get_num_threads()} threads")
+    passed = True
+    if args.model and args.lines:
+        passed &= check_recognition(args, candidate)
+    if args.leaves:
+        passed &= check_detection(args, candidate)
+    if not passed:
+        raise SystemExit("accuracy regression above tolerance")
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
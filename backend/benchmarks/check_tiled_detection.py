@@ -0,0 +1,92 @@
+"""
+Equivalence check of segmentation.detect_tiled against whole-leaf detection:
+the stitched region and affinity scores, and the point cloud extracted from
+them, are compared for several tile sizes.
+
+Run from the backend directory:
+
+    python -m benchmarks.check_tiled_detection [--image LEAF] [--model craft_mlt_25k.pth]
+
+Without --image a synthetic leaf with rows of text is used. Without --model
+(or if the default checkpoint is missing) the detector has random weights,
+which still checks the stitching but not the tolerance on real heatmaps.
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from annotator.segmentation import (
+    CRAFT, CRAFT_MODEL_PATH, copyStateDict, detect_prepared, detect_tiled, heatmap_to_pointcloud,
+    loadImage, prepare_image,
+)
+
+
+def synthetic_leaf(height=2400, width=3600, seed=0):
+    """ light paper with dark rows of random glyph-like text """
+    rng = np.random.default_rng(seed)
+    leaf = np.full((height, width, 3), (225, 210, 180), dtype=np.uint8)
+    leaf = np.clip(leaf + rng.normal(0, 6, leaf.shape), 0, 255).astype(np.uint8)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    for y in range(160, height - 100, 110):
+        x = 120
+        while x < width - 300:
+            word = "".join(rng.choice(list(letters), rng.integers(2, 8)))
+            cv2.putText(leaf, word, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (40, 30, 20), 3, cv2.LINE_AA)
+            x += 40 * len(word) + 50
+    return leaf
+
+
+def load_detector(model_path, device):
+    detector = CRAFT()
+    if model_path is not None and os.path.exists(model_path):
+        detector.load_state_dict(copyStateDict(torch.load(model_path, map_location=device)))
+    else:
+        print("no CRAFT checkpoint, using random weights")
+        torch.manual_seed(0)
+    return detector.to(device).eval()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="leaf image, default: a synthetic leaf")
+    parser.add_argument("--model", default=CRAFT_MODEL_PATH)
+    parser.add_argument("--tile-sizes", type=int, nargs="+", default=[768, 1024, 1536])
+    parser.add_argument("--overlap", type=int, default=256)
+    parser.add_argument("--tolerance", type=float, default=0.05, help="max abs difference of the region score")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    detector = load_detector(args.model, device)
+    leaf = loadImage(args.image) if args.image else synthetic_leaf()
+    x = prepare_image(leaf)
+
+    (region, affinity), t_full = timed(detect_prepared, x, detector, device)
+    points = heatmap_to_pointcloud(region)
+    print(f"leaf {leaf.shape[1]}x{leaf.shape[0]}, whole leaf: {t_full:.2f}s, {len(points)} points")
+
+    print(f"{'tile':>6} {'time (s)':>9} {'max |d region|':>15} {'mean |d region|':>16} {'max |d affinity|':>17} {'same points':>12}")
+    for tile_size in args.tile_sizes:
+        (tiled_region, tiled_affinity), t_tiled = timed(detect_tiled, x, detector, device, tile_size, args.overlap)
+        assert tiled_region.shape == region.shape and tiled_affinity.shape == affinity.shape
+        region_diff = np.abs(tiled_region - region)
+        affinity_diff = np.abs(tiled_affinity - affinity)
+        tiled_points = heatmap_to_pointcloud(tiled_region)
+        same_points = len(tiled_points) == len(points) and np.array_equal(tiled_points, points)
+        print(f"{tile_size:>6} {t_tiled:9.2f} {region_diff.max():15.5f} {region_diff.mean():16.6f} "
+              f"{affinity_diff.max():17.5f} {str(same_points):>12}")
+        assert region_diff.max() <= args.tolerance, \
+            f"tiled region score differs by {region_diff.max():.4f} (> {args.tolerance}) with {tile_size}px tiles"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Check that a TorchScript recognition artifact (<name>.torchscript.pt, see
+recognition.export) loads and runs without the Python model code: imports of
+annotator.recognition.model and annotator.recognition.modules are blocked
+before recognise_lines() is imported.
+
+Run from the backend directory:
+
+    python -m benchmarks.check_torchscript_standalone \
+        --model instance/models/recognition/<name>.torchscript.pt --lines <folder of line images>
+"""
+import argparse
+import importlib.abc
+import sys
+
+BLOCKED = ("annotator.recognition.model", "annotator.recognition.modules")
+
+
+class BlockModelCode(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        if fullname in BLOCKED or fullname.startswith(tuple(f"{name}." for name in BLOCKED)):
+            raise ImportError(f"{fullname} is blocked: TorchScript artifacts must not need it")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True, help="TorchScript artifact")
+    parser.add_argument("--lines", required=True, help="folder of line images (searched recursively)")
+    args = parser.parse_args()
+
+    sys.meta_path.insert(0, BlockModelCode())
+
+    from annotator.recognition.demo import recognise_lines
+    from annotator.recognition.recognition import RECOGNITION_OPTIONS
+    from annotator.recognition.torchscript import artifact_options, is_torchscript
+
+    if not is_torchscript(args.model):
+        raise SystemExit(f"{args.model} is not a TorchScript artifact")
+    results = recognise_lines(
+        image_folder=args.lines, saved_model=args.model, **artifact_options(args.model, RECOGNITION_OPTIONS)
+    )
+
+    loaded = [name for name in sys.modules if name in BLOCKED or name.startswith(tuple(f"{b}." for b in BLOCKED))]
+    assert not loaded, f"model code was imported: {loaded}"
+    print(f"{len(results)} lines recognised without recognition.model / recognition.modules")
+    for result in results[:5]:
+        print(f"  {result['image_path']}: {result['predicted_label']!r} ({result['confidence_score']:.3f})")
+
+
+if __name__ == "__main__":
+    main()